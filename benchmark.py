@@ -0,0 +1,208 @@
+"""
+Benchmarks for MyLib on synthetic book datasets.
+
+Times every MyLib operation and the matching MyLibShell command end to end,
+records peak traced memory per operation, and writes the results as JSON so
+runs can be compared:
+
+    python benchmark.py --sizes 10000 1000000 --out results.json
+    python benchmark.py --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; max RSS is then left out
+    resource = None
+
+from script import MyLib, MyLibShell, np
+
+SIZES = (10000, 1000000, 10000000)
+JOIN_SIZE = 10000
+REGRESSION_THRESHOLD = 0.2
+NOISE_SECONDS = 0.005  # Differences below this are timer noise, never regressions
+AUTHORS = ('Robert Jordan', 'V. E. Schwab', 'Ursula K. Le Guin', 'Terry Pratchett', 'N. K. Jemisin',
+           'Brandon Sanderson', 'Octavia E. Butler', 'Iain M. Banks', 'Robin Hobb', 'Ted Chiang')
+
+
+def generate_books(count, seed=0):
+    """Yield count books with the fields the code expects; the same seed gives the same books."""
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            'title': f"Book {i:08d}",
+            'pages': rng.randint(50, 1500),
+            'publishedYear': rng.randint(1900, 2023),
+            'isbn': f"978{i:010d}",
+            'status': rng.choice(AUTHORS),
+        }
+
+
+def write_dataset(name, count, seed=0):
+    # Written one record at a time so 10M books never sit in memory at once
+    with open(name + '.json', 'w') as file:
+        file.write('[')
+        for i, book in enumerate(generate_books(count, seed)):
+            file.write(', ' if i else '')
+            file.write(json.dumps(book))
+        file.write(']')
+
+
+# (name, MyLib call, MyLibShell command). Mutations come last so every query sees the generated data.
+OPERATIONS = [
+    ('LOAD', lambda db: db.load_dataset('books'), 'load books'),
+    ('FIND', lambda db: db.find_books('pages', '1400', '>'), 'find books whose pages greater than 1400'),
+    ('COUNT', lambda db: db.count('pages', '>', '1000'), 'count book WHERE pages > 1000'),
+    ('SUM', lambda db: db.sum('publishedYear', '<', '1950'), 'sum book WHERE publishedYear < 1950'),
+    ('AVERAGE', lambda db: db.average('status', '=', 'Robin Hobb'), 'average book WHERE status = Robin Hobb'),
+    ('MAX', lambda db: db.Max(), 'max book'),
+    ('MIN', lambda db: db.minimum(), 'min book'),
+    ('SORTBY', lambda db: db.sort_by('publishedYear', where='pages < 100', limit=100),
+     'sortby publishedYear DESC WHERE pages < 100 LIMIT 100'),
+    ('JOIN', lambda db: db.join('others', 'isbn'), 'join others isbn'),
+    ('ADD', lambda db: db.add_record({'title': 'Benchmark API', 'pages': 321, 'publishedYear': 2024,
+                                      'isbn': '0000000000001', 'status': 'Benchmark'}),
+     'add {"title": "Benchmark Shell", "pages": 321, "publishedYear": 2024, "isbn": "0000000000002", '
+     '"status": "Benchmark"}'),
+    ('UPDATE', lambda db: db.update_record('status', 'Updated', 'publishedYear', '=', '1999'),
+     'update status = Updated WHERE publishedYear = 2000'),
+    ('DELETE', lambda db: db.delete_record('pages', '<', '60'), 'delete WHERE pages < 60 AND pages >= 55'),
+]
+
+
+def _measure(run, memory, rerun=None):
+    """
+    Seconds taken by run(), and the peak traced bytes of a second, traced run
+    when memory is set. rerun replaces run for the traced run when repeating
+    run on the same instance would not redo its work.
+    """
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    if not memory:
+        return seconds, None
+    tracemalloc.start()
+    try:
+        (rerun or run)()
+        return seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _shell_runner(shell, command):
+    def run():
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as sink:
+            sys.stdout = sink
+            try:
+                shell.onecmd(command)
+            finally:
+                sys.stdout = stdout
+    return run
+
+
+def bench_size(size, memory=True, seed=0):
+    """Generate a dataset of size books in a scratch directory and time every operation on it."""
+    results = []
+    workdir = tempfile.mkdtemp(prefix=f"mylib-bench-{size}-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.perf_counter()
+        write_dataset('books', size, seed)
+        write_dataset('others', min(size, JOIN_SIZE), seed + 1)
+        shutil.copy('books.json', 'books.orig')
+        print(f"{size} books generated in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+        for interface in ('api', 'shell'):
+            # Each interface starts from the generated data; the other one's mutations are on disk
+            shutil.copy('books.orig', 'books.json')
+            for suffix in ('.log', '.stats', '.idx'):
+                if os.path.exists('books.json' + suffix):
+                    os.remove('books.json' + suffix)
+
+            db = MyLib()
+            db.results = None  # The timed and traced runs would otherwise repeat a query and hit the result cache
+            shell = MyLibShell(db)
+            for name, call, command in OPERATIONS:
+                run = (lambda: call(db)) if interface == 'api' else _shell_runner(shell, command)
+                # The traced rerun of a mutation would find nothing left to change, so those are timed only
+                traced = memory and name not in ('ADD', 'UPDATE', 'DELETE')
+                rerun = None
+                if name == 'LOAD':
+                    # Loading again only resyncs with the files, so trace a load into a fresh instance
+                    fresh = MyLib()
+                    rerun = (lambda: call(fresh)) if interface == 'api' else _shell_runner(MyLibShell(fresh), command)
+                seconds, peak = _measure(run, traced, rerun)
+                results.append({'size': size, 'interface': interface, 'operation': name,
+                                'seconds': round(seconds, 6), 'peak_bytes': peak})
+                print(f"{size:>10} {interface:<5} {name:<8} {seconds:10.4f}s"
+                      + (f" {peak / 2 ** 20:10.1f} MiB" if peak is not None else ''), file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Operations that got more than threshold slower than in the baseline run."""
+    previous = {(row['size'], row['interface'], row['operation']): row['seconds'] for row in baseline['results']}
+    regressions = []
+    for row in results:
+        before = previous.get((row['size'], row['interface'], row['operation']))
+        if before and row['seconds'] > before * (1 + threshold) and row['seconds'] - before > NOISE_SECONDS:
+            regressions.append(dict(row, baseline_seconds=before, slowdown=round(row['seconds'] / before, 3)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark MyLib on synthetic book datasets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='dataset sizes in books')
+    parser.add_argument('--out', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--compare', metavar='BASELINE', help='results file of an earlier run to check against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='slowdown, as a fraction, that counts as a regression (default 0.2)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced runs that measure peak memory')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+
+    results = []
+    for size in options.sizes:
+        results.extend(bench_size(size, not options.no_memory, options.seed))
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np is not None,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'results': results,
+    }
+
+    status = 0
+    if options.compare:
+        with open(options.compare, 'r') as file:
+            report['regressions'] = compare(results, json.load(file), options.threshold)
+        for row in report['regressions']:
+            print(f"REGRESSION {row['size']} {row['interface']} {row['operation']}: "
+                  f"{row['baseline_seconds']:.4f}s -> {row['seconds']:.4f}s (x{row['slowdown']})", file=sys.stderr)
+        status = 1 if report['regressions'] else 0
+
+    with open(options.out, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {options.out}.", file=sys.stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,150 +1,3051 @@
+import argparse
+import asyncio
+import bisect
 import cmd
+import contextlib
+import functools
+import heapq
+import inspect
+import io
+import ipaddress
+import itertools
 import json
+import mmap
+import operator
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # The columnar aggregation path is optional
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Advisory file locks are POSIX-only; elsewhere only in-process locking applies
+    fcntl = None
+
+CHUNK_SIZE = 10000
+CHUNK_CACHE = 8  # Clean chunks kept loaded per chunked dataset; modified ones stay until flushed
+MANIFEST_FILE = 'manifest.json'
+LOG_FILE = 'wal.log'
+LOG_CHECKPOINT_BYTES = 1 << 20
+BINARY_MAGIC = b'JDB1'
+INDEX_FILE = 'indexes.json'
+STATS_FILE = 'stats.json'
+STATS_FIELDS = ('pages', 'publishedYear')
+JOIN_MODES = ('inner', 'left', 'semi', 'group')
+JOIN_CACHE_SIZE = 4
+RESULT_CACHE_ENTRIES = 128
+RESULT_CACHE_BYTES = 64 << 20
+MEMORY_BUDGET = 1 << 30
+DATASET_STATE = ('current_data', 'current_file', 'indexes', 'columns', 'stats', '_batches', '_synced')
+PARALLEL_THRESHOLD = 1000000
+PARALLEL_WORKERS = os.cpu_count() or 1
+SERVER_ADDRESS = '127.0.0.1:7437'
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+COMPACT_ROWS = False  # Rows save a third of the memory but load and scan about 2x slower
+SHARED_VALUES = 4096
+PLAN_CACHE_SIZE = 64  # Shapes kept per command
+SHARD_KEY = 'title'
+SHARD_MANIFEST = '.shards'
+SHARD_AUTHKEY_ENV = 'MYLIB_SHARD_AUTHKEY'
+
+
+def _kind(value):
+    # Only numbers and strings take part in chunk min/max pruning
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return 'num'
+    if isinstance(value, str):
+        return 'str'
+    return None
+
+
+def _chunk_stats(rows):
+    stats = {}
+    for row in rows:
+        for field, value in row.items():
+            kind = _kind(value)
+            if field not in stats:
+                stats[field] = [kind, value, value] if kind else None
+                continue
+            bounds = stats[field]
+            if bounds is None:
+                continue
+            if kind != bounds[0]:
+                stats[field] = None
+            elif value < bounds[1]:
+                bounds[1] = value
+            elif value > bounds[2]:
+                bounds[2] = value
+    return stats
+
+
+def _may_match(stats, field, operator, value):
+    """Return False only when the chunk stats prove no row can match."""
+    if operator not in ('=', '>', '>=', '<', '<='):
+        return True
+    if field not in stats:
+        return False
+    bounds = stats[field]
+    if bounds is None or _kind(value) != bounds[0]:
+        return True
+    low, high = bounds[1], bounds[2]
+    if operator == '=':
+        return low <= value <= high
+    if operator == '>':
+        return high > value
+    if operator == '>=':
+        return high >= value
+    if operator == '<':
+        return low < value
+    return low <= value
+
+
+def _coerce(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+CONDITION_OPERATORS = ('!=', '>=', '<=', '=', '>', '<', 'contains')
+_ATOM_PATTERN = re.compile(r'\s*(\S+?)\s*(!=|>=|<=|=|>|<|(?i:contains)(?=\s))\s*(.*?)\s*$')
+_WORD_PATTERN = re.compile(r'\w+')
+_TERM_PATTERN = re.compile(r'\w+\*?')
+
+
+def _parse_atom(text):
+    match = _ATOM_PATTERN.match(text)
+    if not match or not match.group(3):
+        raise ValueError(f"Invalid condition: {text.strip()}")
+    field, operator, value = match.groups()
+    return (field, operator.lower(), value.strip('"'))
+
+
+def _text_words(text):
+    # The lowercased words of a string; a string without any is indexed under ''
+    return set(_WORD_PATTERN.findall(text.lower())) or {''}
+
+
+def _text_terms(text):
+    """The words of a CONTAINS query; a trailing * makes a word a prefix."""
+    terms = _TERM_PATTERN.findall(str(text).lower())
+    if not terms:
+        raise ValueError(f"No words to search for: {text}")
+    return terms
+
+
+def parse_condition(text, parse_atom=_parse_atom):
+    """
+    Parse "pages >= 300 AND NOT status = Robert Jordan OR ..." into nested
+    ('OR'|'AND', left, right) / ('NOT', inner) / (field, operator, value) tuples.
+    OR binds loosest, then AND, then NOT.
+    """
+    parts = text.split(' OR ')
+    if len(parts) > 1:
+        return ('OR', parse_condition(' OR '.join(parts[:-1]), parse_atom), parse_condition(parts[-1], parse_atom))
+    parts = text.split(' AND ')
+    if len(parts) > 1:
+        return ('AND', parse_condition(' AND '.join(parts[:-1]), parse_atom), parse_condition(parts[-1], parse_atom))
+    text = text.strip()
+    if text.startswith('NOT '):
+        return ('NOT', parse_condition(text[4:], parse_atom))
+    return parse_atom(text)
+
+
+_PAGE_PATTERN = re.compile(r'^(.*?)(?:\s+LIMIT\s+(\d+)(?:\s+OFFSET\s+(\d+))?)?(?:\s+INTO\s+(\S+))?\s*$',
+                           re.IGNORECASE | re.DOTALL)
+
+
+def _page_clause(line):
+    """Split "... [LIMIT n [OFFSET m]] [INTO file]" off a command: (rest, limit, offset, file)."""
+    rest, limit, offset, target = _PAGE_PATTERN.match(line).groups()
+    return rest, int(limit) if limit else None, int(offset) if offset else 0, target
+
+
+_PHRASES = [(' contains ', 'contains'), (' at least ', '>='), (' is not ', '!='), (' is ', '='), (' greater than ', '>'),
+            (' less than ', '<'), (' at most ', '<=')]
+
+
+def _parse_phrase(text):
+    # FIND's wording: "pages at least 300", "status is not Robert Jordan", ...
+    for phrase, operator in _PHRASES:
+        if phrase in text:
+            field, _, value = text.partition(phrase)
+            return (field.strip(), operator, value.strip())
+    raise ValueError(f"Invalid condition: {text}")
+
+
+AGGREGATES = ('COUNT', 'SUM', 'AVG', 'MIN', 'MAX')
+_SELECT_CLAUSE = re.compile(r'\s+(GROUP\s+BY|WHERE)\s+', re.IGNORECASE)
+_SELECT_ITEM = re.compile(r'(\w+)\s*(?:\(\s*(\S*?)\s*\)|\s+(\S+))?$')
+
+
+def parse_select(text):
+    """
+    Parse "status, COUNT, SUM pages, AVG(publishedYear) GROUP BY status WHERE ..."
+    into (group fields, [(aggregate, field or None), ...], where text or None).
+    GROUP BY and WHERE may come in either order.
+    """
+    parts = _SELECT_CLAUSE.split(text.strip())
+    items, clauses = parts[0], {}
+    for clause, value in zip(parts[1::2], parts[2::2]):
+        clause = 'GROUP' if clause.upper().startswith('GROUP') else 'WHERE'
+        if clause in clauses:
+            raise ValueError(f"{clause} given twice")
+        clauses[clause] = value.strip()
+    keys, where = clauses.get('GROUP'), clauses.get('WHERE')
+    keys = [key.strip() for key in keys.split(',')] if keys else []
+
+    aggregates = []
+    for item in items.split(','):
+        item = item.strip()
+        found = _SELECT_ITEM.match(item)
+        if found is None:
+            raise ValueError(f"Invalid select item: {item}")
+        name, field = found.group(1), found.group(2) or found.group(3)
+        if name.upper() in AGGREGATES:
+            if name.upper() != 'COUNT' and not field:
+                raise ValueError(f"{name.upper()} needs a field")
+            aggregates.append((name.upper(), field or None))
+        elif field or name not in keys:
+            raise ValueError(f"Field {item} must be an aggregate or appear in GROUP BY")
+    if not aggregates and not keys:
+        raise ValueError("Nothing to select")
+    return keys, aggregates, where
+
+
+def format_condition(condition):
+    if condition is None:
+        return ''
+    if condition[0] == 'NOT' and isinstance(condition[1], (list, tuple)):
+        return f"NOT {format_condition(condition[1])}"
+    if condition[0] in ('AND', 'OR') and isinstance(condition[1], (list, tuple)):
+        return f" {condition[0]} ".join(format_condition(part) for part in condition[1:])
+    return f"{condition[0]} {condition[1]} {condition[2]}"
+
+
+def compile_condition(condition):
+    """
+    Turn a condition into a predicate over records. The literal is coerced to a
+    number once here, so the returned callable does no dispatch or conversion
+    per row; rows whose value cannot be compared with it simply do not match.
+    """
+    if condition is None:
+        return lambda record: True
+
+    if condition[0] == 'NOT' and isinstance(condition[1], (list, tuple)):
+        inner = compile_condition(condition[1])
+        return lambda record: not inner(record)
+    if condition[0] in ('AND', 'OR') and isinstance(condition[1], (list, tuple)):
+        left, right = compile_condition(condition[1]), compile_condition(condition[2])
+        if condition[0] == 'AND':
+            return lambda record: left(record) and right(record)
+        return lambda record: left(record) or right(record)
+
+    field, operator, value = condition
+    if operator not in CONDITION_OPERATORS:
+        raise ValueError(f"Invalid operator: {operator}")
+    if operator == 'contains':
+        # Every term must be a word of the value, or prefix one when it ends in *
+        terms = [(term[:-1], True) if term.endswith('*') else (term, False) for term in _text_terms(value)]
+
+        def predicate(record):
+            text = record.get(field)
+            if not isinstance(text, str):
+                return False
+            words = _text_words(text)
+            return all(any(word.startswith(term) for word in words) if prefix else term in words
+                       for term, prefix in terms)
+        return predicate
+    literal = _coerce(value)
+
+    if operator in ('=', '!='):
+        if literal != value:
+            # "504" matches both the number 504 and the string "504"
+            equals = lambda record: record.get(field) in (literal, value)
+        else:
+            equals = lambda record: record.get(field) == literal
+        if operator == '=':
+            return equals
+        return lambda record: not equals(record)
+
+    if operator == '>':
+        def predicate(record):
+            try:
+                return record.get(field) > literal
+            except TypeError:
+                return False
+    elif operator == '>=':
+        def predicate(record):
+            try:
+                return record.get(field) >= literal
+            except TypeError:
+                return False
+    elif operator == '<':
+        def predicate(record):
+            try:
+                return record.get(field) < literal
+            except TypeError:
+                return False
+    else:
+        def predicate(record):
+            try:
+                return record.get(field) <= literal
+            except TypeError:
+                return False
+    return predicate
+
+
+_tracing = threading.local()
+
+
+def _new_trace():
+    return {'rows_scanned': 0, 'rows_matched': 0, 'bytes_read': 0, 'serialize_seconds': 0.0, 'cache_hits': 0}
+
+
+def _active_trace():
+    return getattr(_tracing, 'trace', None)
+
+
+def _note(key, amount=1):
+    # Counters cost nothing unless a PROFILE or a metrics hook is collecting them
+    trace = getattr(_tracing, 'trace', None)
+    if trace is not None:
+        trace[key] += amount
+
+
+@contextlib.contextmanager
+def tracing():
+    """Collect rows scanned and matched, bytes read and serialization time for everything run in the block."""
+    previous = _active_trace()
+    _tracing.trace = trace = _new_trace()
+    try:
+        yield trace
+    finally:
+        _tracing.trace = previous
+        if previous is not None:
+            for key, value in trace.items():
+                previous[key] += value
+
+
+def _counted(rows, key):
+    trace = _active_trace()
+    if trace is None:
+        return rows
+    return _counting(rows, trace, key)
+
+
+def _counting(rows, trace, key):
+    for row in rows:
+        trace[key] += 1
+        yield row
+
+
+_ABSENT = object()  # The cell of a field a Row does not have
+
+
+class Schema:
+    """
+    The field names shared by every Row of one dataset, in first-seen order.
+    Repeated string and int values are shared too: each field keeps one copy
+    of every value until it has seen SHARED_VALUES distinct ones (titles,
+    ISBNs), after which its values are stored as they come.
+    """
+
+    def __init__(self, fields=()):
+        self.fields = []
+        self.positions = {}
+        self.shared = []
+        for field in fields:
+            self.position(field)
+
+    def position(self, field):
+        position = self.positions.get(field)
+        if position is None:
+            field = sys.intern(field)
+            position = self.positions[field] = len(self.fields)
+            self.fields.append(field)
+            self.shared.append({})
+        return position
+
+    def share(self, position, value):
+        shared = self.shared[position]
+        # Exact types only: 1, 1.0 and True are equal keys but must stay distinct values
+        if shared is None or (type(value) is not str and type(value) is not int):
+            return value
+        value = shared.setdefault(value, value)
+        if len(shared) > SHARED_VALUES:
+            self.shared[position] = None
+        return value
+
+    def share_row(self, values):
+        """Cells for values given in schema order; share() inlined, as every loaded record goes through it."""
+        cells = []
+        for position, value in enumerate(values):
+            shared = self.shared[position]
+            if shared is not None and (type(value) is str or type(value) is int):
+                value = shared.setdefault(value, value)
+                if len(shared) > SHARED_VALUES:
+                    self.shared[position] = None
+            cells.append(value)
+        return tuple(cells)
+
+
+class Row(MutableMapping):
+    """
+    A record held as a tuple of values ordered by its dataset's Schema, in
+    place of a dict of its own. Reads and writes like a dict; the fields it
+    lacks hold _ABSENT, and it iterates in schema order.
+    """
+    __slots__ = ('schema', 'cells')
+
+    def __init__(self, schema, record=()):
+        self.schema = schema
+        if type(record) is dict and len(record) == len(schema.fields) and list(record) == schema.fields:
+            self.cells = schema.share_row(record.values())
+            return
+        cells = []
+        for field, value in (record.items() if isinstance(record, Mapping) else record):
+            position = schema.position(field)
+            if position >= len(cells):
+                cells.extend([_ABSENT] * (position + 1 - len(cells)))
+            cells[position] = schema.share(position, value)
+        self.cells = tuple(cells)
+
+    def get(self, field, default=None):
+        position = self.schema.positions.get(field)
+        if position is None or position >= len(self.cells):
+            return default
+        value = self.cells[position]
+        return default if value is _ABSENT else value
+
+    def __getitem__(self, field):
+        value = self.get(field, _ABSENT)
+        if value is _ABSENT:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field, _ABSENT) is not _ABSENT
+
+    def __setitem__(self, field, value):
+        position = self.schema.position(field)
+        cells = list(self.cells) + [_ABSENT] * (position + 1 - len(self.cells))
+        cells[position] = self.schema.share(position, value)
+        self.cells = tuple(cells)
+
+    def __delitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        cells = list(self.cells)
+        cells[self.schema.positions[field]] = _ABSENT
+        self.cells = tuple(cells)
+
+    def __iter__(self):
+        return (field for field, value in zip(self.schema.fields, self.cells) if value is not _ABSENT)
+
+    def __len__(self):
+        return sum(1 for value in self.cells if value is not _ABSENT)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        row = Row.__new__(Row)
+        row.schema, row.cells = self.schema, self.cells
+        return row
+
+
+class RowList(list):
+    """The records of a single-file dataset as Rows sharing one Schema."""
+    __slots__ = ('schema',)
+
+    def __init__(self, records=(), schema=None):
+        self.schema = Schema() if schema is None else schema
+        if isinstance(records, list):
+            # Convert in place so each dict is freed as its Row is made, keeping the load's peak memory down
+            for position, record in enumerate(records):
+                records[position] = Row(self.schema, record)
+            super(RowList, self).__init__(records)
+        else:
+            super(RowList, self).__init__(Row(self.schema, record) for record in records)
+
+
+def _plain(value):
+    # json default= hook: Rows serialize as the objects they stand for
+    if isinstance(value, Row):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_json_array(path, buffer_size=1 << 16):
+    """Yield the elements of the top-level JSON array in path one at a time."""
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as file:
+        buffer = ''
+        position = 0
+        started = eof = False
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n' + (',' if started else ''):
+                position += 1
+            if position >= len(buffer):
+                if eof:
+                    return
+                buffer, position = file.read(buffer_size), 0
+                eof = not buffer
+                _note('bytes_read', len(buffer))
+                continue
+
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError(f"{path} does not hold a JSON array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                complete = end < len(buffer) or eof  # A number may continue in the next read
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                more = file.read(buffer_size)
+                eof = not more
+                buffer, position = buffer[position:] + more, 0
+                continue
+
+            yield item
+            position = end
+
+
+def _read_log(path, offset=0):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as file:
+        file.seek(offset)
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return  # Torn write from a crash, nothing after it was acknowledged
+
+
+def _replay_stream(rows, entries):
+    """Apply logged mutations to a stream of base records without materializing it."""
+    steps = [(entry['op'], compile_condition(entry.get('where')), entry) for entry in entries]
+
+    def replay(record, start):
+        for op, predicate, entry in steps[start:]:
+            if op == 'update' and predicate(record):
+                record[entry['field']] = entry['value']
+            elif op == 'delete' and predicate(record):
+                return None
+        return record
+
+    for record in rows:
+        record = replay(record, 0)
+        if record is not None:
+            yield record
+
+    for position, (op, _, entry) in enumerate(steps):
+        if op == 'add':
+            record = replay(dict(entry['record']), position + 1)
+            if record is not None:
+                yield record
+
+
+def dataset_path(filename):
+    """The directory of a chunked dataset, or the path of <filename>.jdb or <filename>.json, or None."""
+    if os.path.exists(os.path.join(filename, MANIFEST_FILE)):
+        return filename
+    if os.path.exists(filename + '.jdb'):
+        return filename + '.jdb'
+    if os.path.exists(filename + '.json'):
+        return filename + '.json'
+    return None
+
+
+def _dataset_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, MANIFEST_FILE), os.path.join(path, LOG_FILE)]
+    return [path, path + '.log']
+
+
+def _dataset_signature(path):
+    signature = []
+    for name in _dataset_files(path):
+        try:
+            stat = os.stat(name)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return signature
+
+
+def _write_stats(path, stats, dataset):
+    """Save stats to path, keyed by the signature of the base files of dataset they describe."""
+    with open(path + '.tmp', 'w') as file:
+        json.dump(dict(stats.to_json(), base=list(_dataset_signature(dataset)[0])), file)
+    os.replace(path + '.tmp', path)
+
+
+def _dataset_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path) + (os.path.getsize(path + '.log') if os.path.exists(path + '.log') else 0)
+
+
+def _log_start(path):
+    """
+    Where the part of a dataset's log still to replay begins. Before a
+    checkpoint replaces the base files it leaves a marker naming the base it
+    started from and the log size it folds in; if it stopped before removing
+    the log, a base that no longer matches the marker already holds that much.
+    """
+    try:
+        with open(_dataset_files(path)[1] + '.checkpoint', 'r') as file:
+            marker = json.load(file)
+    except FileNotFoundError:
+        return 0
+    return marker['log'] if list(_dataset_signature(path)[0] or ()) != marker['base'] else 0
+
+
+def stream_dataset(path, atom=None):
+    """
+    Yield the records of the dataset at path one at a time, straight from its
+    files, with any logged mutations applied on the fly. atom, a
+    (field, operator, value) condition, lets chunked datasets skip chunks.
+    """
+    chunked = os.path.isdir(path)
+    entries = list(_read_log(_dataset_files(path)[1], _log_start(path)))
+
+    if chunked:
+        with open(os.path.join(path, MANIFEST_FILE), 'r') as file:
+            chunks = json.load(file)['chunks']
+        # Logged updates may move rows out of a chunk's recorded range
+        if atom is not None and not entries:
+            chunks = [meta for meta in chunks if _may_match(meta['stats'], atom[0], atom[1], _coerce(atom[2]))]
+        rows = (record for meta in chunks for record in iter_json_array(os.path.join(path, meta['file'])))
+    elif path.endswith('.jdb'):
+        rows = BinaryData(path).iter_records()
+    else:
+        rows = iter_json_array(path)
+
+    return _replay_stream(rows, entries) if entries else rows
+
+
+def _join_key(record, field):
+    key = record.get(field)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def iter_ndjson(path):
+    """Yield one record per non-empty line of a newline-delimited JSON file."""
+    with open(path, 'r') as file:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as error:
+                    raise ValueError(f"Invalid JSON on line {number} of {path}: {error.msg}.") from None
+
+
+def write_json_rows(rows, out, indent=4):
+    """Write rows to out as a JSON array one element at a time; same text as json.dumps(list(rows), indent=indent)."""
+    pad = ' ' * indent
+    count = 0
+    for row in rows:
+        out.write('[\n' if count == 0 else ',\n')
+        out.write(pad + json.dumps(row, indent=indent, default=_plain).replace('\n', '\n' + pad))
+        count += 1
+    out.write('\n]\n' if count else '[]\n')
+    return count
+
+
+def _group_key(record, field):
+    # Unhashable values (lists, objects) group by their JSON text
+    key = record.get(field)
+    try:
+        hash(key)
+    except TypeError:
+        return json.dumps(key, sort_keys=True)
+    return key
+
+
+def _group_rows(rows, keys, fields):
+    """
+    Aggregate rows in one pass into a hash table of group key -> [rows, {field:
+    [present, numeric, sum, min, max]}]. Groups keep the order they were first seen in.
+    """
+    groups = {}
+    for record in rows:
+        key = tuple(_group_key(record, field) for field in keys)
+        state = groups.get(key)
+        if state is None:
+            state = groups[key] = [0, {field: [0, 0, 0, None, None] for field in fields}]
+        state[0] += 1
+        for field, totals in state[1].items():
+            value = record.get(field)
+            if value is None:
+                continue
+            totals[0] += 1
+            if _kind(value) != 'num':
+                continue
+            totals[1] += 1
+            totals[2] += value
+            if totals[3] is None or value < totals[3]:
+                totals[3] = value
+            if totals[4] is None or value > totals[4]:
+                totals[4] = value
+    return groups
+
+
+def _merge_groups(groups, partial):
+    # Fold one partition's table into groups; merging partitions in dataset order keeps first-seen order
+    for key, (rows, fields) in partial.items():
+        state = groups.get(key)
+        if state is None:
+            groups[key] = [rows, fields]
+            continue
+        state[0] += rows
+        for field, totals in fields.items():
+            merged = state[1][field]
+            merged[0] += totals[0]
+            merged[1] += totals[1]
+            merged[2] += totals[2]
+            if totals[3] is not None and (merged[3] is None or totals[3] < merged[3]):
+                merged[3] = totals[3]
+            if totals[4] is not None and (merged[4] is None or totals[4] > merged[4]):
+                merged[4] = totals[4]
+    return groups
+
+
+def _aggregate_label(function, field):
+    return function if field is None else f"{function}({field})"
+
+
+def _group_results(groups, keys, aggregates):
+    """One object per group: its key fields, then every aggregate under its label."""
+    for key, (rows, fields) in groups.items():
+        result = dict(zip(keys, key))
+        for function, field in aggregates:
+            totals = fields.get(field)
+            if function == 'COUNT':
+                value = rows if field is None else totals[0]
+            elif function == 'SUM':
+                value = totals[2]
+            elif function == 'AVG':
+                value = totals[2] / totals[1] if totals[1] else None
+            else:
+                value = totals[3] if function == 'MIN' else totals[4]
+            result[_aggregate_label(function, field)] = value
+        yield result
+
+
+_parallel_data = None  # The dataset forked workers read; set only while a parallel scan runs
+
+
+def _partition_rows(data, part):
+    # A partition is a list of chunk indexes for chunked datasets, else a (start, stop) range
+    if isinstance(data, ChunkedData):
+        for chunk_index in part:
+            for position, record in enumerate(data.chunk(chunk_index)):
+                yield (chunk_index, position), record
+        return
+    start, stop = part
+    rows = data[start:stop] if isinstance(data, list) else (data[position] for position in range(start, stop))
+    for position, record in enumerate(rows, start):
+        yield (None, position), record
+
+
+def _parallel_task(part, condition, kind):
+    """Filter one partition in a worker and send back only row ids or partial aggregates."""
+    predicate = compile_condition(condition)
+    rows = ((row_id, record) for row_id, record in _partition_rows(_parallel_data, part) if predicate(record))
+    if kind == 'find':
+        return [row_id for row_id, _ in rows]
+    if kind == 'count':
+        return sum(1 for _ in rows)
+    if kind == 'sum':
+        return sum(record["pages"] for _, record in rows)
+    if isinstance(kind, tuple):
+        # ('group', keys, fields): the partition's hash aggregation table
+        return _group_rows((record for _, record in rows), kind[1], kind[2])
+
+    count = pages = years = 0
+    number = _average_number(condition)
+    for _, record in rows:
+        years += number(record["publishedYear"])
+        pages += number(record["pages"])
+        count += 1
+    return count, pages, years
+
+
+def _average_number(condition):
+    # AVERAGE with a condition has always truncated each value to int; the plain AVERAGE adds the raw values
+    return int if condition is not None else (lambda value: value)
+
+
+def _encode_binary(record, fields):
+    # Rows shaped like the schema store only their values; any other row stores the full object
+    if list(record) == fields:
+        return json.dumps(list(record.values())).encode()
+    return json.dumps(record, default=_plain).encode()
+
+
+def write_binary(path, rows):
+    """
+    Write rows in the binary dataset format:
+    magic | u32 header length | header {"fields": [...]} | records as u32 length + payload |
+    u64 offset of every record | u64 record count | u64 offset table position | magic
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    fields = list(first) if first is not None else []
+    header = json.dumps({'fields': fields}).encode()
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(BINARY_MAGIC + struct.pack('<I', len(header)) + header)
+        offsets = array('Q')
+        for record in itertools.chain([first] if first is not None else [], rows):
+            offsets.append(file.tell())
+            payload = _encode_binary(record, fields)
+            file.write(struct.pack('<I', len(payload)) + payload)
+        table = file.tell()
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        file.write(offsets.tobytes())
+        file.write(struct.pack('<QQ', len(offsets), table) + BINARY_MAGIC)
+    os.replace(path + '.tmp', path)
+
+
+class BinaryData:
+    """
+    A dataset in the binary format, memory-mapped and decoded one record at a
+    time on access. Decoded records are kept so they stay the same objects for
+    indexes and in-place updates. Appends are held in memory until the next
+    checkpoint; replacing the rows (a delete) switches to a plain list.
+    """
+
+    def __init__(self, path, compact=False):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != BINARY_MAGIC or self.map[-4:] != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a binary dataset")
+
+        header_length, = struct.unpack_from('<I', self.map, 4)
+        self.fields = json.loads(self.map[8:8 + header_length])['fields']
+        self.count, self.table = struct.unpack_from('<QQ', self.map, len(self.map) - 20)
+        self.schema = Schema(self.fields) if compact else None
+        self.decoded = {}
+        self.appended = []
+        self.rows = None
+
+    def _decode(self, position):
+        offset, = struct.unpack_from('<Q', self.map, self.table + 8 * position)
+        length, = struct.unpack_from('<I', self.map, offset)
+        _note('bytes_read', 4 + length)
+        value = json.loads(self.map[offset + 4:offset + 4 + length])
+        record = dict(zip(self.fields, value)) if isinstance(value, list) else value
+        return record if self.schema is None else Row(self.schema, record)
+
+    def iter_records(self):
+        """Decode every record once without keeping them, for streaming reads."""
+        for position in range(self.count):
+            yield self._decode(position)
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+        return self.count + len(self.appended)
+
+    def __getitem__(self, position):
+        if self.rows is not None:
+            return self.rows[position]
+        if position < 0:
+            position += len(self)
+        if position >= self.count:
+            return self.appended[position - self.count]
+        if position < 0:
+            raise IndexError('record index out of range')
+        if position not in self.decoded:
+            self.decoded[position] = self._decode(position)
+        return self.decoded[position]
+
+    def __iter__(self):
+        if self.rows is not None:
+            yield from self.rows
+            return
+        for position in range(self.count):
+            yield self[position]
+        yield from self.appended
+
+    def __setitem__(self, position, value):
+        if isinstance(position, slice):
+            if position != slice(None):
+                raise TypeError('BinaryData only supports replacing all rows')
+            self.rows = list(value)
+            self.decoded = self.appended = None
+        elif self.rows is not None:
+            self.rows[position] = value
+        elif position >= self.count:
+            self.appended[position - self.count] = value
+        else:
+            self.decoded[position] = value
+
+    def loaded(self):
+        """(position, record) for every record decoded or appended so far."""
+        if self.rows is not None:
+            return list(enumerate(self.rows))
+        return list(self.decoded.items()) + list(enumerate(self.appended, self.count))
+
+    def append(self, record):
+        if self.rows is not None:
+            self.rows.append(record)
+        else:
+            self.appended.append(record)
+
+
+class ChunkedData:
+    """
+    A dataset stored as a directory of fixed-size chunk files plus a manifest
+    holding per-chunk row counts and min/max for each field. Chunks are read
+    from disk only when a query needs them, and only the cache most recently
+    used clean chunks stay loaded. Rewritten chunks go to new files, so
+    replacing the manifest switches to all of them at once.
+    """
+
+    def __init__(self, directory, compact=False, cache=CHUNK_CACHE):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE), 'r') as file:
+            manifest = json.load(file)
+        self.chunk_size = manifest['chunk_size']
+        self.chunks = manifest['chunks']
+        self.version = manifest.get('version', 0)
+        self.schema = Schema() if compact else None
+        self.loaded = OrderedDict()  # Least recently used first
+        self.dirty = set()
+        self.cache = cache
+        # Records referenced by identity (built indexes, a running write) must stay the loaded ones
+        self.pinned = False
+        self.holds = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, directory, data=None, chunk_size=CHUNK_SIZE):
+        os.makedirs(directory)
+        with open(os.path.join(directory, MANIFEST_FILE), 'w') as file:
+            json.dump({'chunk_size': chunk_size, 'chunks': []}, file)
+        store = cls(directory)
+        for record in data or []:
+            store.append(record)
+        store.flush()
+        return store
+
+    def chunk(self, index):
+        with self._lock:
+            rows = self.loaded.get(index)
+            if rows is not None:
+                self.loaded.move_to_end(index)
+                return rows
+        try:
+            rows = self._read(index)
+        except FileNotFoundError:
+            # Another process checkpointed since the manifest was read and removed the file it replaced
+            with open(os.path.join(self.directory, MANIFEST_FILE), 'r') as file:
+                self.chunks[index] = json.load(file)['chunks'][index]
+            rows = self._read(index)
+        if self.schema is not None:
+            rows = [Row(self.schema, record) for record in rows]
+        with self._lock:
+            rows = self.loaded.setdefault(index, rows)  # Another reader may have loaded it meanwhile
+            self._trim()
+        return rows
+
+    def _trim(self):
+        if self.pinned or self.holds:
+            return
+        clean = [index for index in self.loaded if index not in self.dirty]
+        for index in clean[:max(0, len(clean) - self.cache)]:
+            del self.loaded[index]
+
+    @contextlib.contextmanager
+    def held(self):
+        """Keep every chunk loaded in the block, for writes that change records they found earlier in it."""
+        self.holds += 1
+        try:
+            yield
+        finally:
+            self.holds -= 1
+            with self._lock:
+                self._trim()
+
+    def _read(self, index):
+        path = os.path.join(self.directory, self.chunks[index]['file'])
+        with open(path, 'r') as file:
+            rows = json.load(file)
+        _note('bytes_read', os.path.getsize(path))
+        return rows
+
+    def touch(self, index):
+        self.dirty.add(index)
+
+    def candidate_chunks(self, field, operator, value):
+        for index, meta in enumerate(self.chunks):
+            # Stats of modified chunks are stale until the next flush
+            if index in self.dirty or _may_match(meta['stats'], field, operator, value):
+                yield index
+
+    def append(self, record):
+        if not self.chunks or len(self.chunk(len(self.chunks) - 1)) >= self.chunk_size:
+            index = len(self.chunks)
+            self.chunks.append({'file': None, 'rows': 0, 'stats': {}})  # Named when flushed
+            self.loaded[index] = []
+        index = len(self.chunks) - 1
+        self.chunk(index).append(record)
+        self.touch(index)
+
+    def flush(self):
+        """
+        Write every dirty chunk to a new file, then replace the manifest. That
+        replace is the only commit point: a crash before it leaves the old
+        manifest naming the old, untouched chunk files.
+        """
+        self.version += 1
+        for index in sorted(self.dirty):
+            rows = self.loaded[index]
+            name = f"chunk_{index:05d}.{self.version}.json"
+            with open(os.path.join(self.directory, name), 'w') as file:
+                json.dump(rows, file, default=_plain)
+            self.chunks[index] = {'file': name, 'rows': len(rows), 'stats': _chunk_stats(rows)}
+
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump({'chunk_size': self.chunk_size, 'version': self.version, 'chunks': self.chunks}, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self.dirty.clear()
+        with self._lock:
+            self._trim()
+
+        # The files just replaced, and any a crashed flush wrote, are named by no manifest now
+        current = {meta['file'] for meta in self.chunks}
+        for name in os.listdir(self.directory):
+            if name.startswith('chunk_') and name.endswith('.json') and name not in current:
+                os.remove(os.path.join(self.directory, name))
+
+    def __len__(self):
+        return sum(len(self.loaded[i]) if i in self.loaded else meta['rows']
+                   for i, meta in enumerate(self.chunks))
+
+    def __iter__(self):
+        for index in range(len(self.chunks)):
+            yield from self.chunk(index)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        for index, meta in enumerate(self.chunks):
+            rows = len(self.loaded[index]) if index in self.loaded else meta['rows']
+            if position < rows:
+                return self.chunk(index)[position]
+            position -= rows
+        raise IndexError('record index out of range')
+
+
+class ColumnCache:
+    """
+    NumPy arrays of numeric fields in row order, so aggregates can run as
+    vectorized masks instead of Python loops. Appends are buffered and
+    concatenated on the next read; updates drop the changed column and
+    deletes drop every column, to be rebuilt on next use.
+    """
+
+    def __init__(self, fields=('pages', 'publishedYear')):
+        self.fields = set(fields)
+        self.columns = {}
+        self.pending = {}
+        self.lock = threading.Lock()  # Readers build and extend columns, so they take turns
+
+    def get(self, field, rows):
+        with self.lock:
+            if field not in self.columns:
+                self.columns[field] = self._build([row.get(field) for row in rows()])
+                self.pending[field] = []
+            elif self.pending[field]:
+                column = self.columns[field]
+                if column is not None:
+                    self.columns[field] = self._build(self.pending[field], column)
+                self.pending[field] = []
+            return self.columns[field]
+
+    def _build(self, values, head=None):
+        # Only all-number columns are cached; missing values become NaN
+        if any(value is not None and _kind(value) != 'num' for value in values):
+            return None
+        try:
+            if all(type(value) is int for value in values) and (head is None or head.dtype.kind == 'i'):
+                column = np.array(values, dtype=np.int64)
+            else:
+                column = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        except OverflowError:
+            return None
+        return column if head is None else np.concatenate([head, column])
+
+    def append(self, record):
+        for field in self.columns:
+            self.pending[field].append(record.get(field))
+
+    def invalidate(self, field=None):
+        if field is None:
+            self.columns.clear()
+            self.pending.clear()
+        else:
+            self.columns.pop(field, None)
+            self.pending.pop(field, None)
+
+
+class DatasetStats:
+    """
+    Running row count and per-field count, sum, min and max of numeric
+    fields, kept current on every add, update and delete. Removing the
+    current min or max marks the field stale until it is recomputed.
+    """
+
+    def __init__(self, fields=STATS_FIELDS):
+        self.rows = 0
+        self.fields = {field: {'count': 0, 'sum': 0, 'min': None, 'max': None, 'other': 0}
+                       for field in fields}
+        self.stale = set()
+
+    @classmethod
+    def build(cls, rows, fields=STATS_FIELDS):
+        stats = cls(fields)
+        for record in rows:
+            stats.add(record)
+        return stats
+
+    def add(self, record):
+        self.rows += 1
+        for field, stat in self.fields.items():
+            value = record.get(field)
+            if _kind(value) != 'num':
+                stat['other'] += 1
+                continue
+            stat['count'] += 1
+            stat['sum'] += value
+            if stat['min'] is None or value < stat['min']:
+                stat['min'] = value
+            if stat['max'] is None or value > stat['max']:
+                stat['max'] = value
+
+    def remove(self, record):
+        self.rows -= 1
+        for field, stat in self.fields.items():
+            value = record.get(field)
+            if _kind(value) != 'num':
+                stat['other'] -= 1
+                continue
+            stat['count'] -= 1
+            stat['sum'] -= value
+            if value == stat['min'] or value == stat['max']:
+                self.stale.add(field)
+
+    def numeric(self, field):
+        """The stats of field when every row holds a number there, else None."""
+        stat = self.fields.get(field)
+        if stat is None or stat['other']:
+            return None
+        return stat
+
+    def to_json(self):
+        return {'rows': self.rows, 'fields': self.fields, 'stale': sorted(self.stale)}
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls(data['fields'])
+        stats.rows = data['rows']
+        stats.fields = data['fields']
+        stats.stale = set(data['stale'])
+        return stats
+
+
+class HashIndex:
+    """
+    Maps each value of one field to the (chunk_index, record) pairs holding it.
+    Records never move between chunks, so the chunk index stays valid.
+    """
+
+    def __init__(self, field, unique=False):
+        self.field = field
+        self.unique = unique
+        self.entries = {}
+        self.built = False
+
+    def add(self, chunk_index, record):
+        try:
+            self.entries.setdefault(record.get(self.field), []).append((chunk_index, record))
+        except TypeError:
+            pass  # Unhashable values can never equal a query literal
+
+    def remove(self, record, value):
+        try:
+            bucket = self.entries.get(value)
+        except TypeError:
+            return
+        if not bucket:
+            return
+        bucket[:] = [entry for entry in bucket if entry[1] is not record]
+        if not bucket:
+            del self.entries[value]
+
+    def discard(self, records):
+        """Remove many records at once, filtering each affected bucket a single time."""
+        by_value = {}
+        for record in records:
+            try:
+                by_value.setdefault(record.get(self.field), set()).add(id(record))
+            except TypeError:
+                pass
+        for value, removed in by_value.items():
+            bucket = [entry for entry in self.entries.get(value, []) if id(entry[1]) not in removed]
+            if bucket:
+                self.entries[value] = bucket
+            else:
+                self.entries.pop(value, None)
+
+    def lookup(self, value):
+        try:
+            return self.entries.get(value, [])
+        except TypeError:
+            return []
+
+
+class SortedIndex:
+    """
+    Keeps the (chunk_index, record) pairs of a numeric field ordered by value
+    with bisect, for range conditions, index-ordered SORTBY and MAX/MIN.
+    Rows whose value is not a number are counted in excluded and kept in a
+    side hash instead, so = conditions still find them.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.unique = False
+        self.keys = []
+        self.entries = []
+        self.excluded = 0
+        self.others = HashIndex(field)
+        self.built = False
+
+    def add(self, chunk_index, record):
+        value = record.get(self.field)
+        if _kind(value) != 'num':
+            self.excluded += 1
+            self.others.add(chunk_index, record)
+            return
+        position = bisect.bisect_right(self.keys, value)
+        self.keys.insert(position, value)
+        self.entries.insert(position, (chunk_index, record))
+
+    def remove(self, record, value):
+        if _kind(value) != 'num':
+            self.excluded -= 1
+            self.others.remove(record, value)
+            return
+        low = bisect.bisect_left(self.keys, value)
+        high = bisect.bisect_right(self.keys, value)
+        for position in range(low, high):
+            if self.entries[position][1] is record:
+                del self.keys[position]
+                del self.entries[position]
+                return
+
+    def discard(self, records):
+        if len(records) < 32:
+            for record in records:
+                self.remove(record, record.get(self.field))
+            return
+        removed = {id(record) for record in records}
+        others = [record for record in records if _kind(record.get(self.field)) != 'num']
+        self.excluded -= len(others)
+        self.others.discard(others)
+        kept = [position for position, entry in enumerate(self.entries) if id(entry[1]) not in removed]
+        self.keys = [self.keys[position] for position in kept]
+        self.entries = [self.entries[position] for position in kept]
+
+    def lookup(self, value):
+        # Compared like conditions compare: True also finds 1, and 1 finds True in the side hash
+        found = self.others.lookup(value) if self.excluded else []
+        if isinstance(value, (int, float)):
+            low = bisect.bisect_left(self.keys, value)
+            found = self.entries[low:bisect.bisect_right(self.keys, value)] + found
+        return found
+
+    def range(self, operator, value):
+        if _kind(value) != 'num':
+            return []
+        low, high = 0, len(self.keys)
+        if operator in ('=', '>='):
+            low = bisect.bisect_left(self.keys, value)
+        elif operator == '>':
+            low = bisect.bisect_right(self.keys, value)
+        if operator in ('=', '<='):
+            high = bisect.bisect_right(self.keys, value)
+        elif operator == '<':
+            high = bisect.bisect_left(self.keys, value)
+        return self.entries[low:high]
+
+
+class TextIndex:
+    """
+    Inverted index from each lowercased word of a string field to the
+    (chunk_index, record) pairs whose value holds it, for CONTAINS searches.
+    The words are also kept sorted, so a prefix* term is one bisect range.
+    Values that are not strings go to a side hash for = conditions.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.unique = False
+        self.postings = {}
+        self.words = None  # Sorted postings keys, rebuilt after words come or go
+        self.others = HashIndex(field)
+        self.built = False
+
+    def add(self, chunk_index, record):
+        value = record.get(self.field)
+        if not isinstance(value, str):
+            self.others.add(chunk_index, record)
+            return
+        for word in _text_words(value):
+            bucket = self.postings.get(word)
+            if bucket is None:
+                bucket = self.postings[word] = {}
+                self.words = None
+            bucket[id(record)] = (chunk_index, record)
+
+    def remove(self, record, value):
+        if not isinstance(value, str):
+            self.others.remove(record, value)
+            return
+        for word in _text_words(value):
+            bucket = self.postings.get(word)
+            if bucket is not None and bucket.pop(id(record), None) is not None and not bucket:
+                del self.postings[word]
+                self.words = None
+
+    def discard(self, records):
+        for record in records:
+            self.remove(record, record.get(self.field))
+
+    def _matching(self, term):
+        # Postings of one query term, merged over every word it prefixes when it ends in *
+        if not term.endswith('*'):
+            return self.postings.get(term, {})
+        if self.words is None:
+            self.words = sorted(self.postings)
+        prefix = term[:-1]
+        merged = {}
+        for position in range(bisect.bisect_left(self.words, prefix), len(self.words)):
+            if not self.words[position].startswith(prefix):
+                break
+            merged.update(self.postings[self.words[position]])
+        return merged
+
+    def search(self, text):
+        """Entries whose value holds every word of text, walking the smallest posting list."""
+        buckets = sorted((self._matching(term) for term in _text_terms(text)), key=len)
+        first, rest = buckets[0], buckets[1:]
+        return [entry for key, entry in first.items() if all(key in bucket for bucket in rest)]
+
+    def lookup(self, value):
+        # Exact matches, for = conditions and duplicate checks: records holding all its words, then compared
+        if not isinstance(value, str):
+            return self.others.lookup(value)
+        words = _text_words(value)
+        buckets = sorted((self.postings.get(word, {}) for word in words), key=len)
+        return [entry for key, entry in buckets[0].items()
+                if entry[1].get(self.field) == value and all(key in bucket for bucket in buckets[1:])]
+
+
+class RWLock:
+    """
+    Many readers or one writer. A waiting writer holds off new readers so
+    writes are not starved, and the writing thread may re-enter either side.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        if self.writer == threading.get_ident():
+            yield
+            return
+        with self.condition:
+            while self.writer is not None or self.waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer != me:
+                self.waiting += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting -= 1
+                self.writer = me
+            self.depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.depth -= 1
+                if not self.depth:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+def _index_type(index):
+    if isinstance(index, SortedIndex):
+        return 'sorted'
+    return 'text' if isinstance(index, TextIndex) else 'hash'
+
+
+def _reading(method):
+    # Queries that walk live structures (indexes, chunks) hold the read lock for the whole call
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def _writing(method):
+    # Mutations hold the write lock
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.write():
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                # Any write may change query answers; bumped before readers can see the new data
+                self.generation += 1
+    return locked
+
+
+def _syncing(method):
+    """
+    Logged writes to the loaded dataset, committed in groups. Each call queues
+    itself; the first caller to find no group committing leads, and until the
+    queue is empty runs everything queued as one group, with one fold-in of
+    what other processes wrote and one log append. The others wait for their
+    write to be done, so writers arriving during an append share the next one,
+    and each write's checks (uniqueness, matches) still see every earlier write.
+    """
+    @functools.wraps(method)
+    def synced(self, *args, **kwargs):
+        if getattr(self._local, 'grouped', False):
+            return method(self, *args, **kwargs)  # Called by a write already running in a group
+        write = {'run': functools.partial(method, self, *args, **kwargs), 'done': threading.Event(),
+                 'session': getattr(self._local, 'session', None),
+                 'trace': _active_trace(), 'observing': getattr(_tracing, 'observing', False)}
+        if self.lock.writer == threading.get_ident():
+            self._commit_group([write])  # Inside another write, which a leader would wait for
+        else:
+            with self._queue_lock:
+                self._writes.append(write)
+                lead, self._committing = not self._committing, True
+            while lead:
+                with self._queue_lock:
+                    writes, self._writes = self._writes, []
+                    lead = self._committing = bool(writes)
+                if writes:
+                    self._commit_group(writes)
+            write['done'].wait()
+        if 'error' in write:
+            raise write['error']
+        return write['result']
+    return synced
+
+
+def _position(rows, record):
+    # By identity, at C speed: list.index would compare rows by value, which builds two dicts per Row
+    return next(itertools.compress(itertools.count(), map(operator.is_, rows, itertools.repeat(record))))
+
+
+def _footprint(data):
+    """Rough bytes held by a dataset's decoded records: their count times a sampled per-record size."""
+    if isinstance(data, ChunkedData):
+        records = [record for rows in data.loaded.values() for record in rows]
+    elif isinstance(data, BinaryData):
+        records = [record for _, record in data.loaded()]
+    else:
+        records = data
+    if not records:
+        return 0
+    sample = records[::max(1, len(records) // 100)][:100]
+    # A Row's values live in its cells tuple; shared strings are still counted once per record
+    per_record = sum(sys.getsizeof(record) + sys.getsizeof(getattr(record, 'cells', ()))
+                     + sum(sys.getsizeof(value) for value in record.values()) for record in sample) / len(sample)
+    return int(per_record * len(records))
+
+
+class ResultCache:
+    """
+    Serialized query answers in LRU order, bounded by entry count and total
+    characters. Entries belong to one write generation of the dataset; the
+    first lookup after a write drops them all.
+    """
+
+    def __init__(self, entries=RESULT_CACHE_ENTRIES, size=RESULT_CACHE_BYTES):
+        self.entries = entries
+        self.size = size
+        self.results = OrderedDict()
+        self.used = 0
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def _check(self, generation):
+        if generation != self.generation:
+            self.results.clear()
+            self.used = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self.lock:
+            self._check(generation)
+            entry = self.results.get(key)
+            if entry is not None:
+                self.results.move_to_end(key)
+            return entry
+
+    def put(self, key, generation, written, returned):
+        cost = len(written or '') + len(returned or '')
+        with self.lock:
+            self._check(generation)
+            if cost > self.size or key in self.results:
+                return
+            self.results[key] = (written, returned)
+            self.used += cost
+            while len(self.results) > self.entries or self.used > self.size:
+                old_written, old_returned = self.results.popitem(last=False)[1]
+                self.used -= len(old_written or '') + len(old_returned or '')
+
+
+class _Capture:
+    # Passes writes through to out and keeps a copy while it stays under limit characters
+    def __init__(self, out, limit):
+        self.out = out
+        self.limit = limit
+        self.parts = []
+        self.used = 0
+
+    def write(self, text):
+        self.out.write(text)
+        if self.parts is not None:
+            self.used += len(text)
+            if self.used > self.limit:
+                self.parts = None
+            else:
+                self.parts.append(text)
+
+    def text(self):
+        return None if self.parts is None else ''.join(self.parts)
+
+
+def _cached(method):
+    # Answer repeated queries from the result cache; the key is the normalized query plus the write generation
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def cached(self, *args, **kwargs):
+        if self.results is None:
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        del arguments['self']
+        out = arguments.pop('out', None)
+        try:
+            key = self._query_key(method.__name__, arguments, out is None)
+        except ValueError:
+            return method(self, *args, **kwargs)
+
+        generation = self.generation
+        entry = self.results.get(key, generation)
+        if entry is not None:
+            _note('cache_hits')
+            written, returned = entry
+            if out is not None and written:
+                out.write(written)
+            return returned
+
+        if out is None:
+            returned = method(self, *args, **kwargs)
+            self.results.put(key, generation, None, returned)
+            return returned
+        capture = _Capture(out, self.results.size)
+        bound.arguments['out'] = capture
+        returned = method(*bound.args, **bound.kwargs)
+        if capture.text() is not None:
+            self.results.put(key, generation, capture.text(), returned)
+        return returned
+    return cached
+
+
+class MetricsRecorder:
+    """
+    A metrics hook keeping, per operation, a call count, total latency, a
+    latency histogram over LATENCY_BUCKETS and summed row/byte counters.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, operation, seconds, trace):
+        with self.lock:
+            metrics = self.operations.setdefault(operation, {
+                'calls': 0, 'seconds': 0.0, 'histogram': [0] * (len(self.buckets) + 1), **_new_trace()})
+            metrics['calls'] += 1
+            metrics['seconds'] += seconds
+            metrics['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+            for key, value in trace.items():
+                metrics[key] += value
+
+    def to_json(self):
+        with self.lock:
+            return {'buckets': list(self.buckets), 'operations': json.loads(json.dumps(self.operations))}
+
+
+class Explained(BaseException):
+    """Raised in place of running an operation under EXPLAIN; carries the plan past the shell's error handling."""
+
+    def __init__(self, plan):
+        super(Explained, self).__init__(plan)
+        self.plan = plan
+
+
+def _observed(method):
+    # Outermost public calls go to the metrics hooks with their latency and counters; EXPLAIN only plans them
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def observed(self, *args, **kwargs):
+        if self.explaining:
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            raise Explained(self.explain(method.__name__, arguments))
+        if not self.hooks or getattr(_tracing, 'observing', False):
+            return method(self, *args, **kwargs)
+
+        _tracing.observing = True
+        try:
+            with tracing() as trace:
+                start = time.perf_counter()
+                result = method(self, *args, **kwargs)
+                seconds = time.perf_counter() - start
+        finally:
+            _tracing.observing = False
+        for hook in self.hooks:
+            hook(method.__name__, seconds, trace)
+        return result
+    return observed
+
+
+# Query methods and the arguments holding their condition, for EXPLAIN
+_EXPLAINED = {
+    'find_books': ('field', 'operator', 'value'),
+    'count': ('field', 'operator', 'value'),
+    'sum': ('field', 'operator', 'value'),
+    'average': ('field', 'operator', 'value'),
+    'update_record': ('condition_field', 'condition_operator', 'condition_value'),
+    'delete_record': ('condition_field', 'condition_operator', 'condition_value'),
+    'sort_by': ('condition_field', 'condition_operator', 'condition_value'),
+}
+
+# Shell commands that read through stream_source; anything else would run against the loaded dataset
+STREAM_COMMANDS = ('find', 'count', 'sum', 'average')
+
+# Shell commands whose only dataset access is an observed call, so EXPLAIN can stop them before they run
+EXPLAINABLE_COMMANDS = ('find', 'count', 'sum', 'average', 'select', 'sortby', 'join', 'max', 'min',
+                        'update', 'delete', 'add', 'load', 'convert', 'checkpoint')
+
 
 class MyLib:
     def __init__(self):
         self.data_files = []
         self.current_data = None
         self.current_file = None
+        self.indexes = {}
+        self.columns = ColumnCache()
+        self._join_cache = OrderedDict()
+        self._batches = {}  # Open batches by session
+        self.stats = None
+        self.parallel_threshold = PARALLEL_THRESHOLD
+        self.parallel_workers = PARALLEL_WORKERS
+        self.lock = RWLock()
+        # Indexes, stats and the join cache are built on first use, under only the read lock
+        self._build_lock = threading.RLock()
+        self._log_queue = []
+        self._writes = []  # Logged writes waiting for the next group commit
+        self._committing = False
+        self._queue_lock = threading.Lock()
+        self._disk_lock = threading.RLock()
+        self._file_locks = set()
+        self._writer = f"{os.getpid()}:{id(self)}"
+        self._synced = None
+        self.hooks = []
+        self._local = threading.local()
+        self.explaining = False
+        self.stream_source = None
+        self.generation = 0
+        self.results = ResultCache()
+        # Datasets other than the current one that stay parsed, least recently used first
+        self.catalog = OrderedDict()
+        self.memory_budget = MEMORY_BUDGET
+        self.compact = COMPACT_ROWS
+
+    @property
+    def explaining(self):
+        # Per thread, so one server session's EXPLAIN does not stop another session's queries
+        return getattr(self._local, 'explaining', False)
+
+    @explaining.setter
+    def explaining(self, value):
+        self._local.explaining = value
+
+    @property
+    def stream_source(self):
+        # Per thread too: STREAM opens and closes it within one command, and must not redirect other sessions
+        return getattr(self._local, 'stream_source', None)
+
+    @stream_source.setter
+    def stream_source(self, path):
+        self._local.stream_source = path
+
+    @property
+    def _batch(self):
+        # The batch of the session running on this thread; outside the server there is only one
+        return self._batches.get(getattr(self._local, 'session', None))
+
+    @_batch.setter
+    def _batch(self, entries):
+        session = getattr(self._local, 'session', None)
+        if entries is None:
+            self._batches.pop(session, None)
+        else:
+            self._batches[session] = entries
+
+    @contextlib.contextmanager
+    def session(self, key):
+        """Run this thread's calls in the block for session key, which has its own BEGIN ... COMMIT batch."""
+        previous = getattr(self._local, 'session', None)
+        self._local.session = key
+        try:
+            yield
+        finally:
+            self._local.session = previous
+
+    def end_session(self, key):
+        """Commit the batch session key left open: its changes are already visible to every other session."""
+        with self.session(key):
+            if self._batch is not None:
+                return self.commit()
+        return None
+
+    def create_dataset(self, filename, data=None, chunk_size=CHUNK_SIZE):
+        if dataset_path(filename) is not None or os.path.exists(filename):
+            return f"Dataset {filename} already exists!"
+
+        ChunkedData.create(filename, data, chunk_size)
+
+        self.data_files.append(filename)
+        return f"Dataset {filename} created."
+
+    @_writing
+    def chunk_dataset(self, filename, chunk_size=CHUNK_SIZE):
+        """Convert a single-file <filename>.json dataset into chunked storage."""
+        if os.path.exists(filename):
+            return f"Dataset {filename} is already chunked!"
+        if not os.path.exists(filename + '.json'):
+            return f"File {filename}.json not found!"
+
+        path = filename + '.json'
+        loaded = self.current_file == path
+        if loaded:
+            self.save_dataset()
+        store = ChunkedData.create(filename, stream_dataset(path), chunk_size)
+        self.catalog.pop(path, None)
+
+        if filename not in self.data_files:
+            self.data_files.append(filename)
+        if loaded:
+            # LOAD <filename> now opens the chunks; switching to them parks the old file's state
+            self.load_dataset(filename)
+            self.catalog.pop(path, None)
+        return f"Dataset {filename} split into {len(store.chunks)} chunks."
+
+    def _open_dataset(self, filename):
+        path = dataset_path(filename)
+        if path is None:
+            return None, None
+
+        if os.path.isdir(path):
+            return ChunkedData(path, self.compact), path
+        if path.endswith('.jdb'):
+            return BinaryData(path, self.compact), path
+
+        _note('bytes_read', os.path.getsize(path))
+        with open(path, 'r') as file:
+            data = json.load(file)
+        return (RowList(data) if self.compact else data), path
+
+    @_observed
+    @_writing
+    def convert_dataset(self, filename, target):
+        """Rewrite a single-file dataset as <filename>.jdb (binary) or <filename>.json (json)."""
+        target = target.lower()
+        if target not in ('binary', 'json'):
+            return "Invalid format. Use binary or json."
+
+        path = dataset_path(filename)
+        if path is None:
+            return f"File {filename}.json not found!"
+        if os.path.isdir(path):
+            return f"Dataset {filename} is chunked; CONVERT works on single-file datasets."
+        new_path = filename + ('.jdb' if target == 'binary' else '.json')
+        if path == new_path:
+            return f"Dataset {filename} is already stored as {target}."
+
+        loaded = self.current_file == path
+        if loaded:
+            self.save_dataset()
+        self.catalog.pop(path, None)
+
+        # The new file folds in any pending log, so the saved stats no longer describe it: rebuild them on the way
+        stats = DatasetStats()
+        rows = (stats.add(record) or record for record in stream_dataset(path))
+        if target == 'binary':
+            write_binary(new_path, rows)
+        else:
+            with open(new_path + '.tmp', 'w') as file:
+                write_json_rows(rows, file)
+            os.replace(new_path + '.tmp', new_path)
+        _write_stats(new_path + '.stats', stats, new_path)
+        # Index definitions name fields only, so they still hold
+        if os.path.exists(path + '.idx'):
+            os.replace(path + '.idx', new_path + '.idx')
+        for name in (path, path + '.stats', path + '.log'):
+            if os.path.exists(name):
+                os.remove(name)
+
+        if loaded:
+            # Switching to the new file parks the old one's state, which no LOAD or CLOSE can reach
+            self.load_dataset(filename)
+            self.catalog.pop(path, None)
+        return f"Dataset {filename} converted to {new_path}."
+
+    @_observed
+    @_writing
+    def load_dataset(self, filename):
+        path = dataset_path(filename)
+        if path is None:
+            return f"File {filename}.json not found!"
+        if path != self.current_file:
+            self._stash()
+            state = self.catalog.pop(path, None)
+            if state is not None:
+                self._restore(state)
+        # Another process must not checkpoint between reading the base files and replaying the log
+        with self._file_lock(path):
+            if path == self.current_file:
+                self._sync()  # Open already: only what other processes wrote since needs reading
+                message = f"Dataset {path} loaded."
+            else:
+                message = self._load_dataset(filename)
+        self._evict()
+        return message
+
+    def _stash(self):
+        # Park the current dataset in the catalog so switching back does not parse it again
+        if self.current_file is not None and self.current_data is not None:
+            self.catalog[self.current_file] = {name: getattr(self, name) for name in DATASET_STATE}
+            self.current_data = self.current_file = None
+
+    def _restore(self, state):
+        for name in DATASET_STATE:
+            setattr(self, name, state[name])
+
+    def _evict(self):
+        """Drop least recently used datasets until the open ones fit memory_budget; they reload on the next LOAD."""
+        if self.memory_budget is None:
+            return
+        used = _footprint(self.current_data) if self.current_data is not None else 0
+        sizes = OrderedDict((path, _footprint(state['current_data'])) for path, state in self.catalog.items())
+        used += sum(sizes.values())
+        for path, size in sizes.items():
+            if used <= self.memory_budget:
+                break
+            if self.catalog[path]['_batches']:
+                continue  # Its open batches exist only in memory
+            del self.catalog[path]
+            used -= size
+
+    def _resident_rows(self, path):
+        """The records of an open dataset when memory still matches its files, else None."""
+        if path == self.current_file:
+            state = {name: getattr(self, name) for name in DATASET_STATE}
+        else:
+            state = self.catalog.get(path)
+        if state is None or state['_synced'] is None or state['_batches']:
+            return None
+        base, log = _dataset_signature(path)
+        if (base, log[1] if log else 0) != state['_synced']:
+            return None
+        return list(state['current_data'])
+
+    def datasets(self):
+        """The open datasets, most recently used last, with their rows and estimated memory."""
+        if self.current_data is None and not self.catalog:
+            return "No datasets open."
+        lines = []
+        states = list(self.catalog.values())
+        if self.current_data is not None:
+            states.append({name: getattr(self, name) for name in DATASET_STATE})
+        for state in states:
+            marker = '*' if state['current_file'] == self.current_file else ' '
+            megabytes = _footprint(state['current_data']) / (1 << 20)
+            lines.append(f"{marker} {state['current_file']}: {len(state['current_data'])} rows, ~{megabytes:.1f} MiB")
+        return '\n'.join(lines)
+
+    @_writing
+    def close_dataset(self, filename):
+        """Forget an open dataset; a later LOAD parses it again."""
+        path = dataset_path(filename)
+        if path is not None and path in self.catalog:
+            if self.catalog[path]['_batches']:
+                return f"Dataset {path} has an open batch; COMMIT it first."
+            del self.catalog[path]
+            return f"Dataset {path} closed."
+        if path is not None and path == self.current_file:
+            if self._batches:
+                return f"Dataset {path} has an open batch; COMMIT it first."
+            self.current_data = self.current_file = None
+            self.indexes, self.stats, self._synced = {}, None, None
+            return f"Dataset {path} closed."
+        return f"Dataset {filename} is not open."
+
+    def set_compact(self, enabled):
+        """Hold datasets loaded from now on as Rows sharing a Schema (less memory) or as plain dicts (faster loads)."""
+        self.compact = enabled
+        return f"Compact rows {'on' if enabled else 'off'} for datasets loaded from now on."
+
+    def set_memory_budget(self, megabytes):
+        self.memory_budget = None if megabytes is None else megabytes << 20
+        with self.lock.write():
+            self._evict()
+        if megabytes is None:
+            return "Memory budget removed."
+        return f"Memory budget set to {megabytes} MiB."
+
+    def _load_dataset(self, filename, checkpoint=True):
+        data, path = self._open_dataset(filename)
+        if data is None:
+            return f"File {filename}.json not found!"
+
+        self.current_data = data
+        self.current_file = path
+        self._synced = _dataset_signature(path)[0], 0
+        self.indexes = {}
+        self._batches = {}
+        self.columns = ColumnCache(self.columns.fields)
+
+        # Saved stats describe the base files they are keyed by; the log replay below keeps them current
+        self.stats = None
+        if os.path.exists(self._stats_path()):
+            with open(self._stats_path(), 'r') as file:
+                saved = json.load(file)
+            if self._synced[0] is not None and saved.get('base') == list(self._synced[0]):
+                self.stats = DatasetStats.from_json(saved)
+
+        # Index definitions persist with the dataset; they are rebuilt on first use, which
+        # the replay below makes once, not a scan for every logged update and delete
+        if os.path.exists(self._index_path()):
+            with open(self._index_path(), 'r') as file:
+                for field, options in json.load(file).items():
+                    if options.get('type') == 'sorted':
+                        self.indexes[field] = SortedIndex(field)
+                    elif options.get('type') == 'text':
+                        self.indexes[field] = TextIndex(field)
+                    else:
+                        self.indexes[field] = HashIndex(field, options['unique'])
+
+        # Replay mutations logged since the last checkpoint and fold them in
+        self._recover_checkpoint()
+        if self._replay_log() and checkpoint:
+            self.save_dataset()
+
+        return f"Dataset {path} loaded."
+
+    def _stats_path(self):
+        if isinstance(self.current_data, ChunkedData):
+            return os.path.join(self.current_file, STATS_FILE)
+        return self.current_file + '.stats'
+
+    def _stats(self):
+        """Dataset stats, built with one scan the first time they are needed and maintained after that."""
+        with self._build_lock:
+            if self.stats is None:
+                self.stats = DatasetStats.build(self._scan())
+                self._keep_stats()
+            for field in list(self.stats.stale):
+                stat = self.stats.fields[field]
+                index = self._index(field)
+                if isinstance(index, SortedIndex) and not index.excluded:
+                    values = [index.keys[0], index.keys[-1]] if index.keys else []
+                else:
+                    values = [row.get(field) for row in self._scan() if _kind(row.get(field)) == 'num']
+                stat['min'] = min(values) if values else None
+                stat['max'] = max(values) if values else None
+                self.stats.stale.discard(field)
+            return self.stats
+
+    def _keep_stats(self):
+        # A read-only workload never checkpoints, so save stats built while memory holds exactly the base files
+        if (self.current_file is None or self._synced is None or self._synced[1] or self._log_queue
+                or any(self._batches.values()) or self._synced[0] != _dataset_signature(self.current_file)[0]):
+            return
+        _write_stats(self._stats_path(), self.stats, self.current_file)
+
+    def _index_path(self):
+        if isinstance(self.current_data, ChunkedData):
+            return os.path.join(self.current_file, INDEX_FILE)
+        return self.current_file + '.idx'
+
+    def _save_indexes(self):
+        with open(self._index_path(), 'w') as file:
+            json.dump({field: {'unique': index.unique, 'type': _index_type(index)}
+                       for field, index in self.indexes.items()}, file)
+
+    def _index(self, field):
+        index = self.indexes.get(field)
+        if index is not None and not index.built:
+            with self._build_lock:
+                if not index.built:  # Another reader may have built it while this one waited
+                    self._pin_records(True)
+                    for chunk_index, rows in self._scan_chunks():
+                        for record in rows:
+                            index.add(chunk_index, record)
+                    index.built = True
+        return index
+
+    @_writing
+    def create_index(self, field, unique=False, kind='hash'):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        if field in self.indexes:
+            return f"Index on {field} already exists."
+        if kind not in ('hash', 'sorted', 'text') or (kind != 'hash' and unique):
+            return "Invalid index type. Use [UNIQUE] INDEX, SORTED INDEX or TEXT INDEX."
+
+        if kind == 'text':
+            index = TextIndex(field)
+        else:
+            index = SortedIndex(field) if kind == 'sorted' else HashIndex(field, unique)
+        self._pin_records(True)
+        for chunk_index, rows in self._scan_chunks():
+            for record in rows:
+                index.add(chunk_index, record)
+        if unique and any(len(bucket) > 1 for bucket in index.entries.values()):
+            self._pin_records()
+            return f"Cannot create unique index: duplicate values in {field}."
 
-    def create_dataset(self, filename, data=None):
-        filename += '.json'
-        if os.path.exists(filename):
-            return f"File {filename} already exists!"
+        index.built = True
+        self.indexes[field] = index
+        self._save_indexes()
+        label = 'Unique index' if unique else {'sorted': 'Sorted index', 'text': 'Text index'}.get(kind, 'Index')
+        return f"{label} on {field} created."
 
-        with open(filename, 'w') as file:
-            json.dump(data if data else [], file)
+    @_writing
+    def drop_index(self, field):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        if self.indexes.pop(field, None) is None:
+            return f"No index on {field}."
 
-        self.data_files.append(filename)
-        return f"Dataset {filename} created."
+        self._pin_records()
+        self._save_indexes()
+        return f"Index on {field} dropped."
 
-    def load_dataset(self, filename):
-        filename += '.json'
-        if not os.path.exists(filename):
-            return f"File {filename} not found!"
+    def _pin_records(self, building=False):
+        # Indexes hold records by identity, so a chunk they point into must not be evicted and read again
+        if isinstance(self.current_data, ChunkedData):
+            self.current_data.pinned = building or any(index.built for index in self.indexes.values())
+
+    def _log_path(self):
+        if isinstance(self.current_data, ChunkedData):
+            return os.path.join(self.current_file, LOG_FILE)
+        return self.current_file + '.log'
+
+    def _log(self, entry):
+        """Append one mutation to the dataset's write-ahead log, or hold it until commit() inside a batch."""
+        if self._batch is not None:
+            if entry['op'] == 'add':
+                # Later changes in the batch must not leak into the logged insert
+                entry = dict(entry, record=dict(entry['record']))
+            self._batch.append(entry)
+            return
+
+        with self._queue_lock:
+            self._log_queue.append((self.current_file, self._log_path(), json.dumps(dict(entry, writer=self._writer)) + '\n'))
+
+    @contextlib.contextmanager
+    def _file_lock(self, path):
+        """
+        Hold the in-process disk lock and an advisory lock on <path>.lock, so
+        checkpoints, log appends and loads never interleave, within this process
+        or across processes sharing the dataset.
+        """
+        with self._disk_lock:
+            if fcntl is None or path in self._file_locks:
+                yield
+                return
+            with open(path + '.lock', 'a') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                self._file_locks.add(path)
+                try:
+                    yield
+                finally:
+                    self._file_locks.discard(path)
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _commit_group(self, writes):
+        """Run writes in order on this thread, each with its own session and trace, and log them with one append."""
+        session, trace, observing = getattr(self._local, 'session', None), _active_trace(), getattr(_tracing, 'observing', False)
+        with self.lock.write():
+            try:
+                with self._file_lock(self.current_file) if self.current_file else contextlib.nullcontext():
+                    if self.current_file:
+                        self._sync()
+                    with self._holding():
+                        for write in writes:
+                            self._local.session, self._local.grouped = write['session'], True
+                            _tracing.trace, _tracing.observing = write['trace'], write['observing']
+                            try:
+                                write['result'] = write['run']()
+                            except BaseException as error:
+                                write['error'] = error  # Raised in the thread that made the call
+                            finally:
+                                self._local.session, self._local.grouped = session, False
+                                _tracing.trace, _tracing.observing = trace, observing
+                    self._flush_log()
+            except BaseException as error:
+                for write in writes:
+                    write.setdefault('error', error)  # The group may not have reached the log
+            finally:
+                # Any write may change query answers; bumped before readers can see the new data
+                self.generation += 1
+                for write in writes:
+                    write['done'].set()
+
+    def _flush_log(self):
+        """
+        Append every queued entry with one write per log file. Writes to the
+        loaded dataset get here from _commit_group, still holding its file lock.
+        """
+        if not self._log_queue:
+            return
+        if self.current_file is not None and self._stale():
+            with self.lock.write():
+                with self._file_lock(self.current_file):
+                    self._sync()
+
+        checkpoint = False
+        with self._disk_lock:
+            with self._queue_lock:
+                entries, self._log_queue = self._log_queue, []
+            groups = OrderedDict()
+            for base, path, line in entries:
+                groups.setdefault((base, path), []).append(line)
+            for (base, path), lines in groups.items():
+                with self._file_lock(base):
+                    with open(path, 'a') as file:
+                        start = file.tell()
+                        file.write(''.join(lines))
+                        end = file.tell()
+                    if base == self.current_file:
+                        # Nothing from other processes came in between, so the whole log is reflected in memory
+                        signature = _dataset_signature(base)[0]
+                        if self._synced == (signature, start):
+                            self._synced = signature, end
+                        checkpoint |= end >= LOG_CHECKPOINT_BYTES
+
+        if checkpoint:
+            self.save_dataset()
+
+    @_writing
+    def begin(self):
+        """Start a batch: mutations apply in memory and reach disk together on commit()."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        if self._batch is not None:
+            return "A batch is already open."
+        self._batch = []
+        return "Batch started."
+
+    @_syncing
+    def commit(self):
+        """Write every mutation of the batch with one log append, or one checkpoint if that is smaller."""
+        if self._batch is None:
+            return "No batch open."
+        entries, self._batch = self._batch, None
+
+        path = self._log_path()
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        lines = []
+        for entry in entries:
+            lines.append(json.dumps(dict(entry, writer=self._writer)) + '\n')
+            size += len(lines[-1])
+            if size >= LOG_CHECKPOINT_BYTES:
+                self.save_dataset()
+                return f"Batch of {len(entries)} changes committed."
+
+        with self._queue_lock:
+            self._log_queue.extend((self.current_file, path, line) for line in lines)
+        return f"Batch of {len(entries)} changes committed."
+
+    def _recover_checkpoint(self):
+        """Finish a checkpoint that stopped before removing the log: drop what the base files already hold."""
+        marker = self._log_path() + '.checkpoint'
+        if not os.path.exists(marker):
+            return
+        start = _log_start(self.current_file)
+        if start and os.path.exists(self._log_path()):
+            with open(self._log_path(), 'rb') as file:
+                file.seek(start)
+                rest = file.read()
+            with open(self._log_path() + '.tmp', 'wb') as file:
+                file.write(rest)
+            os.replace(self._log_path() + '.tmp', self._log_path())
+        os.remove(marker)
+
+    def _replay_log(self):
+        replayed = 0
+        size = os.path.getsize(self._log_path()) if os.path.exists(self._log_path()) else 0
+        for entry in _read_log(self._log_path()):
+            self._apply(entry)
+            replayed += 1
+        self._synced = self._synced[0], size
+        return replayed
+
+    def _stale(self):
+        # Another process has checkpointed, or appended to the log, since this one last synced
+        if self._synced is None:
+            return False
+        base, log = _dataset_signature(self.current_file)
+        return base != self._synced[0] or (log[1] if log else 0) != self._synced[1]
+
+    def _sync(self):
+        """
+        Fold in what other processes wrote to the dataset, under the write lock
+        and the file lock. A newer checkpoint means reloading and reapplying
+        this process's queued entries and open batch; a longer log means
+        replaying its tail.
+        """
+        if not self._stale():
+            return
+        self.generation += 1
+        base, log = _dataset_signature(self.current_file)
+        if base != self._synced[0]:
+            with self._queue_lock:
+                queued = [entry for entry in self._log_queue if entry[1] == self._log_path()]
+                self._log_queue = [entry for entry in self._log_queue if entry[1] != self._log_path()]
+            # Batches exist only in memory, so the new base does not hold them; they stay open on top
+            batches = self._batches
+            name = self.current_file if os.path.isdir(self.current_file) else os.path.splitext(self.current_file)[0]
+            self._load_dataset(name, checkpoint=False)
+            for entry in queued:
+                self._apply(json.loads(entry[2]))
+            for entries in batches.values():
+                for entry in entries:
+                    self._apply(entry)
+            self._batches = batches
+            with self._queue_lock:
+                self._log_queue.extend(queued)
+            return
+
+        size = log[1] if log else 0
+        for entry in _read_log(self._log_path(), self._synced[1]):
+            if entry.get('writer') != self._writer:
+                self._apply(entry)
+        self._synced = base, size
+
+    def _apply(self, entry):
+        with self._holding():
+            op = entry['op']
+            if op == 'add':
+                self._append(entry['record'])
+            elif op == 'update':
+                self._set_field(self._matches(entry['where']), entry['field'], entry['value'])
+            elif op == 'delete':
+                self._delete_where(entry['where'])
+
+    def _holding(self):
+        # Updates and deletes change the records they matched, so the chunks holding them stay loaded meanwhile
+        if isinstance(self.current_data, ChunkedData):
+            return self.current_data.held()
+        return contextlib.nullcontext()
+
+    def _scan_chunks(self, field=None, operator=None, value=None):
+        """
+        Yield (chunk_index, rows) for every block of records that may satisfy
+        the condition. Chunked datasets skip chunks whose manifest min/max rule
+        the condition out; in-memory datasets are a single block.
+        """
+        if isinstance(self.current_data, ChunkedData):
+            for index in self.current_data.candidate_chunks(field, operator, value):
+                yield index, self.current_data.chunk(index)
+        else:
+            yield None, self.current_data
+
+    def _candidates(self, condition=None):
+        """
+        Yield (chunk_index, record) for records that may satisfy the condition.
+        One atom of the condition picks the access path: a hash or sorted index
+        when the field has one, chunk pruning otherwise. Callers still apply
+        the compiled predicate to every candidate.
+        """
+        atom = self._narrowing_atom(condition)
+        if atom is None:
+            for chunk_index, rows in self._scan_chunks():
+                for record in rows:
+                    yield chunk_index, record
+            return
+
+        field, operator, value = atom
+        index = self._index(field)
+        if operator == 'contains':
+            yield from index.search(value)
+            return
+        literal = _coerce(value)
+        if operator == '=' and index is not None:
+            yield from list(index.lookup(literal))
+            if literal != value:
+                yield from list(index.lookup(value))
+            return
+        if isinstance(index, SortedIndex) and _kind(literal) == 'num':
+            yield from index.range(operator, literal)
+            return
+
+        for chunk_index, rows in self._scan_chunks(field, operator, literal):
+            for record in rows:
+                yield chunk_index, record
+
+    def _narrowing_atom(self, condition):
+        # Any atom of an AND narrows the whole condition; OR and NOT need every row
+        if condition is None:
+            return None
+        if condition[0] == 'AND' and isinstance(condition[1], (list, tuple)):
+            atoms = [self._narrowing_atom(part) for part in condition[1:]]
+            atoms = [atom for atom in atoms if atom is not None]
+            indexed = [atom for atom in atoms if atom[0] in self.indexes]
+            return (indexed or atoms or [None])[0]
+        if condition[0] in ('OR', 'NOT') and isinstance(condition[1], (list, tuple)):
+            return None
+        if condition[1] == 'contains':
+            # Only a text index narrows CONTAINS; chunk stats cannot
+            return condition if isinstance(self.indexes.get(condition[0]), TextIndex) else None
+        if condition[1] not in ('=', '>', '>=', '<', '<='):
+            return None
+        return condition
+
+    def _scan(self, condition=None):
+        trace = _active_trace()
+        for _, record in self._candidates(condition):
+            if trace is not None:
+                trace['rows_scanned'] += 1
+            yield record
+
+    def _select(self, condition, limit=None):
+        """
+        Rows matching condition, filtered lazily. Loaded candidates are first
+        copied into a snapshot, so the caller can drop the read lock while it
+        filters and writers carry on. With a limit only that many matches are
+        looked for and copied, so a small page still stops the scan early.
+        """
+        predicate = compile_condition(condition) if condition is not None else None
+        if self.stream_source is None and limit is not None:
+            rows = self._scan(condition)
+            if predicate is not None:
+                rows = (record for record in rows if predicate(record))
+            return _counted(iter(list(itertools.islice(rows, limit))), 'rows_matched')
+        rows = self._stream(condition) if self.stream_source is not None else list(self._scan(condition))
+        if predicate is None:
+            return _counted(iter(rows), 'rows_matched')
+        return _counted((record for record in rows if predicate(record)), 'rows_matched')
+
+    def open_stream(self, filename):
+        """Answer FIND, COUNT, SUM and AVERAGE by reading the dataset from disk instead of current_data."""
+        self.stream_source = dataset_path(filename)
+        if self.stream_source is None:
+            return f"File {filename}.json not found!"
+        return f"Streaming {self.stream_source}."
+
+    def close_stream(self):
+        self.stream_source = None
+
+    def _stream(self, condition=None):
+        return stream_dataset(self.stream_source, self._narrowing_atom(condition))
+
+    def _parallel_eligible(self, condition):
+        if (self.stream_source is not None or self.parallel_threshold is None or self.parallel_workers < 2
+                or len(self.current_data) < self.parallel_threshold
+                or 'fork' not in multiprocessing.get_all_start_methods()):
+            return False
+        atom = self._narrowing_atom(condition)
+        return atom is None or self._index(atom[0]) is None
+
+    def _parallel(self, condition, kind):
+        """
+        Scan a large dataset across worker processes. Returns the partial results
+        of every partition in dataset order, or None when the query should run
+        serially: below parallel_threshold rows, when an index answers it, while
+        streaming, or where workers cannot be forked.
+        """
+        if not self._parallel_eligible(condition):
+            return None
+        atom = self._narrowing_atom(condition)
+
+        if isinstance(self.current_data, ChunkedData):
+            field, operator, value = atom if atom is not None else (None, None, None)
+            chunks = list(self.current_data.candidate_chunks(field, operator, _coerce(value)))
+            size = -(-len(chunks) // self.parallel_workers)
+            parts = [chunks[start:start + size] for start in range(0, len(chunks), size)]
+        else:
+            total = len(self.current_data)
+            size = -(-total // self.parallel_workers)
+            parts = [(start, min(start + size, total)) for start in range(0, total, size)]
+        if not parts:
+            return []
+
+        # Forked workers inherit the dataset, so only partition bounds and results cross processes
+        global _parallel_data
+        _parallel_data = self.current_data
+        try:
+            with ProcessPoolExecutor(len(parts), mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(_parallel_task, parts, itertools.repeat(condition), itertools.repeat(kind)))
+        finally:
+            _parallel_data = None
+
+        if isinstance(self.current_data, ChunkedData):
+            _note('rows_scanned', sum(self.current_data.chunks[index]['rows'] for part in parts for index in part))
+        else:
+            _note('rows_scanned', len(self.current_data))
+        if kind in ('find', 'count', 'average'):
+            _note('rows_matched', sum(len(part) if kind == 'find' else part if kind == 'count' else part[0]
+                                      for part in results))
+        elif isinstance(kind, tuple):
+            _note('rows_matched', sum(state[0] for part in results for state in part.values()))
+        return results
+
+    def _query_key(self, operation, arguments, returned):
+        """A canonical key for a read query: the same question asked two ways maps to one key."""
+        arguments = dict(arguments)
+        condition = None
+        if operation in _EXPLAINED:
+            field, operator, value = (arguments.pop(name) for name in _EXPLAINED[operation])
+            condition = self._where(field, operator, value, arguments.pop('where'))
+        elif operation == 'group_by':
+            condition = self._where(None, None, None, arguments.pop('where'))
+        for name in ('order', 'mode'):
+            if isinstance(arguments.get(name), str):
+                arguments[name] = arguments[name].upper()
+        if operation == 'join':
+            path = dataset_path(arguments['other_dataset'])
+            arguments['other'] = _dataset_signature(path) if path else None
+        source = self.stream_source and [self.stream_source, _dataset_signature(self.stream_source)]
+        return json.dumps([operation, self.current_file, source, condition, arguments, returned],
+                          sort_keys=True, default=str)
+
+    def add_hook(self, hook):
+        """Call hook(operation, seconds, counters) after every public operation, e.g. a MetricsRecorder."""
+        self.hooks.append(hook)
+        return hook
+
+    def explain(self, operation, arguments):
+        """Describe how operation would read the dataset, without running it."""
+        if self.current_data is None and self.stream_source is None:
+            return "No dataset loaded. Load a dataset first."
+
+        if operation in _EXPLAINED:
+            field, operator, value = (arguments.get(name) for name in _EXPLAINED[operation])
+            condition = self._where(field, operator, value, arguments.get('where'))
+        elif operation == 'update_by_value':
+            condition = (arguments['condition_field'], '=', arguments['condition_value'])
+        elif operation == 'group_by':
+            condition = self._where(None, None, None, arguments.get('where'))
+        else:
+            condition = None
+
+        lines = [f"Operation: {operation}"]
+        if operation in _EXPLAINED or operation in ('update_by_value', 'Max', 'minimum', 'group_by'):
+            path = self._access_path(operation, condition, arguments.get('field') if operation == 'sort_by' else None,
+                                     arguments.get('limit'))
+            lines.append(f"Access path: {path}")
+            if condition is not None:
+                lines.append(f"Filter: {format_condition(condition)}")
+            if operation == 'group_by':
+                labels = ', '.join(_aggregate_label(*aggregate) for aggregate in arguments['aggregates'])
+                lines.append(f"Aggregate: hash table on ({', '.join(arguments['keys'])}) computing {labels}")
+        elif operation == 'join':
+            lines.append(f"Access path: hash join of a full scan with {arguments['other_dataset']}"
+                         f" on {arguments['field']} ({arguments.get('mode', 'inner').upper()})")
+        else:
+            lines.append("Access path: none, not a query")
+        return '\n'.join(lines)
+
+    def _access_path(self, operation, condition, sort_field=None, limit=None):
+        # Mirrors the order in which the query methods try their paths
+        if self.stream_source is not None:
+            atom = self._narrowing_atom(condition)
+            if os.path.isdir(self.stream_source) and atom is not None:
+                return f"stream {self.stream_source} from disk, pruning chunks on {format_condition(atom)}"
+            return f"stream {self.stream_source} from disk"
+
+        rows = len(self.current_data)
+        if operation in ('count', 'sum', 'average', 'Max', 'minimum') and condition is None:
+            if operation == 'count':
+                return "row count of the loaded dataset, no scan"
+            return "maintained dataset stats, no scan"
+        if operation in ('count', 'sum', 'average') and self._vectorizable(condition):
+            return f"NumPy mask over cached columns of {rows} rows"
+        # find_books fans out only whole-dataset searches, as a LIMIT stops its serial scan early
+        fans_out = operation != 'find_books' or (limit is None and condition is not None)
+        if operation in ('find_books', 'count', 'sum', 'average', 'group_by') and fans_out and self._parallel_eligible(condition):
+            return f"parallel scan of {rows} rows across {self.parallel_workers} worker processes"
+        index = self.indexes.get(sort_field)
+        if isinstance(index, SortedIndex) and not index.excluded:
+            return f"walk of the sorted index on {sort_field}, no sort"
+
+        atom = self._narrowing_atom(condition)
+        if atom is None:
+            return f"full scan of {rows} rows"
+        field, operator, value = atom
+        literal = _coerce(value)
+        index = self.indexes.get(field)
+        if operator == 'contains':
+            return f"text index search on {field} contains {value}"
+        if operator == '=' and index is not None:
+            return f"{_index_type(index)} index lookup on {field} = {value}"
+        if isinstance(index, SortedIndex) and _kind(literal) == 'num':
+            return f"sorted index range on {field} {operator} {value}"
+        if isinstance(self.current_data, ChunkedData):
+            chunks = len(list(self.current_data.candidate_chunks(field, operator, literal)))
+            return f"chunk pruning on {format_condition(atom)}: {chunks} of {len(self.current_data.chunks)} chunks"
+        return f"full scan of {rows} rows"
+
+    def _vectorizable(self, condition):
+        # Whether _mask can answer the condition from cached NumPy columns
+        if not self._columnar(condition):
+            return False
+        if condition is None:
+            return True
+        if condition[0] == 'NOT' and isinstance(condition[1], (list, tuple)):
+            return self._vectorizable(condition[1])
+        if condition[0] in ('AND', 'OR') and isinstance(condition[1], (list, tuple)):
+            return self._vectorizable(condition[1]) and self._vectorizable(condition[2])
+        return (condition[0] in self.columns.fields and condition[1] != 'contains'
+                and _kind(_coerce(condition[2])) == 'num')
+
+    def set_parallel(self, threshold, workers=None):
+        self.parallel_threshold = threshold
+        if workers is not None:
+            self.parallel_workers = workers
+        if threshold is None:
+            return "Parallel scans disabled."
+        return f"Parallel scans from {threshold} rows with {self.parallel_workers} workers."
+
+    def _rows_of(self, chunk_index):
+        if chunk_index is None:
+            return self.current_data
+        return self.current_data.chunk(chunk_index)
+
+    def _append(self, record):
+        schema = getattr(self.current_data, 'schema', None)
+        if schema is not None and not isinstance(record, Row):
+            record = Row(schema, record)
+        self.current_data.append(record)
+        self.columns.append(record)
+        if self.stats is not None:
+            self.stats.add(record)
+        chunk_index = len(self.current_data.chunks) - 1 if isinstance(self.current_data, ChunkedData) else None
+        for field in self.indexes:
+            index = self.indexes[field]
+            if index.built:
+                index.add(chunk_index, record)
+
+    def _touch(self, chunk_index):
+        if chunk_index is not None:
+            self.current_data.touch(chunk_index)
+
+    def _matches(self, condition):
+        predicate = compile_condition(condition)
+        candidates = list(self._candidates(condition))
+        matches = [(chunk_index, record) for chunk_index, record in candidates if predicate(record)]
+        _note('rows_scanned', len(candidates))
+        _note('rows_matched', len(matches))
+        return matches
+
+    def _set_field(self, matches, field, new_value):
+        # Records are replaced by updated copies rather than changed in place, so reader snapshots stay consistent
+        self.columns.invalidate(field)
+        stats = self.stats if self.stats is not None and field in self.stats.fields else None
+        replaced = {}
+        for chunk_index, record in matches:
+            updates = replaced.setdefault(chunk_index, {})
+            if id(record) in updates:
+                continue
+            updated = record.copy()
+            updated[field] = new_value
+            if stats is not None:
+                stats.remove(record)
+                stats.add(updated)
+            for index in self.indexes.values():
+                if index.built:
+                    index.remove(record, record.get(index.field))
+                    index.add(chunk_index, updated)
+            updates[id(record)] = (record, updated)
+            self._touch(chunk_index)
+
+        for chunk_index, updates in replaced.items():
+            self._replace_records(chunk_index, updates)
+
+    def _replace_records(self, chunk_index, updates):
+        """Swap records in their chunk; updates maps id(old record) to (old record, replacement)."""
+        rows = self._rows_of(chunk_index)
+        if isinstance(rows, BinaryData):
+            positions = rows.loaded()
+        elif len(updates) <= 16:
+            # A few records: find them by identity instead of a Python loop over the chunk
+            positions = [(_position(rows, record), record) for record, _ in updates.values()]
+        else:
+            positions = enumerate(rows)
+        for position, record in positions:
+            update = updates.get(id(record))
+            if update is not None:
+                rows[position] = update[1]
+
+    def _violates_unique(self, matches, field, new_value):
+        index = self._index(field)
+        if index is None or not index.unique or not matches:
+            return False
+        if len(matches) > 1:
+            return True
+        return any(record is not matches[0][1] for _, record in index.lookup(new_value))
+
+    def _delete_where(self, condition):
+        predicate = compile_condition(condition)
+        atom = self._narrowing_atom(condition)
 
-        with open(filename, 'r') as file:
-            self.current_data = json.load(file)
-            self.current_file = filename
+        removed = []
+        if atom is not None and atom[0] in self.indexes:
+            # Few candidates: find them through the index, then rebuild only their chunks
+            matched = {}
+            for chunk_index, record in self._candidates(condition):
+                _note('rows_scanned')
+                if predicate(record):
+                    matched.setdefault(chunk_index, set()).add(id(record))
+            for chunk_index, ids in matched.items():
+                rows = self._rows_of(chunk_index)
+                kept = []
+                for record in rows:
+                    (removed if id(record) in ids else kept).append(record)
+                rows[:] = kept
+                self._touch(chunk_index)
+        else:
+            # Single pass over each candidate chunk, splitting rows into kept and deleted
+            if atom is None:
+                blocks = self._scan_chunks()
+            else:
+                blocks = self._scan_chunks(atom[0], atom[1], _coerce(atom[2]))
+            for chunk_index, rows in blocks:
+                _note('rows_scanned', len(rows))
+                kept = []
+                before = len(removed)
+                for record in rows:
+                    (removed if predicate(record) else kept).append(record)
+                if len(removed) > before:
+                    rows[:] = kept
+                    self._touch(chunk_index)
+
+        _note('rows_matched', len(removed))
+        if removed:
+            for index in self.indexes.values():
+                if index.built:
+                    index.discard(removed)
+            self.columns.invalidate()
+            if self.stats is not None:
+                for record in removed:
+                    self.stats.remove(record)
+        return len(removed)
+
+    @_writing
+    def cache_columns(self, *fields):
+        """Keep more numeric fields as NumPy columns for vectorized conditions and aggregates."""
+        if np is None:
+            return "NumPy is not installed; aggregates use the row-by-row path."
+        self.columns.fields.update(fields)
+        return f"Caching columns: {', '.join(sorted(self.columns.fields))}"
+
+    def _columnar(self, condition=None):
+        if np is None or self.current_data is None or self.stream_source is not None:
+            return False
+        # Columns are built from every row, so where the manifest rules chunks out the pruned row scan reads less
+        return not (isinstance(self.current_data, ChunkedData) and self._prunes(condition))
+
+    def _prunes(self, condition):
+        atom = self._narrowing_atom(condition)
+        if atom is None or atom[1] == 'contains':
+            return False
+        field, operator, value = atom
+        candidates = sum(1 for _ in self.current_data.candidate_chunks(field, operator, _coerce(value)))
+        return candidates < len(self.current_data.chunks)
+
+    def _column(self, field):
+        if not self._columnar():
+            return None
+        if field not in self.columns.fields:
+            return None
+        return self.columns.get(field, self._scan)
+
+    def _mask(self, condition):
+        """Evaluate a condition over the cached columns; None when some part needs the row path."""
+        if condition is None:
+            return np.ones(len(self.current_data), dtype=bool)
+        if condition[0] == 'NOT' and isinstance(condition[1], (list, tuple)):
+            inner = self._mask(condition[1])
+            return None if inner is None else ~inner
+        if condition[0] in ('AND', 'OR') and isinstance(condition[1], (list, tuple)):
+            left, right = self._mask(condition[1]), self._mask(condition[2])
+            if left is None or right is None:
+                return None
+            return left & right if condition[0] == 'AND' else left | right
 
-        return f"Dataset {filename} loaded."
+        field, operator, value = condition
+        literal = _coerce(value)
+        column = self._column(field)
+        if column is None or _kind(literal) != 'num':
+            return None
+        if operator == '=':
+            return column == literal
+        if operator == '!=':
+            return column != literal
+        if operator == '>':
+            return column > literal
+        if operator == '>=':
+            return column >= literal
+        if operator == '<':
+            return column < literal
+        if operator == '<=':
+            return column <= literal
+        return None
+
+    def _columns_where(self, fields, condition):
+        """The selected values of each field as arrays, or None to fall back to the row path."""
+        if not self._columnar(condition):
+            return None
+        columns = [self._column(field) for field in fields]
+        if any(column is None for column in columns):
+            return None
+        mask = self._mask(condition)
+        if mask is None:
+            return None
+        _note('rows_scanned', len(mask))
+        _note('rows_matched', int(mask.sum()))
+        selected = [column[mask] for column in columns]
+        # Missing values raise on the row path, so leave those errors to it
+        if any(column.dtype.kind == 'f' and np.isnan(column).any() for column in selected):
+            return None
+        return selected
+
+    def _duplicate(self, record, titles=None):
+        """Why record cannot be added, or None. titles is a set of existing titles when there is no title index."""
+        title_index = self._index('title')
+        if title_index is not None:
+            if title_index.lookup(record['title']):
+                return "Record with this title already exists."
+        elif titles is not None:
+            if record['title'] in titles:
+                return "Record with this title already exists."
+        elif any(existing_record['title'] == record['title'] for existing_record in self.current_data):
+        	return "Record with this title already exists."
 
+        for field in self.indexes:
+            index = self._index(field)
+            if index.unique and record.get(field) is not None and index.lookup(record.get(field)):
+                return f"Record with this {field} already exists."
+        return None
+
+    @_observed
+    @_syncing
     def add_record(self, record):
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
         
-        if any(existing_record['title'] == record['title'] for existing_record in self.current_data):
-        	return "Record with this title already exists."
+        error = self._duplicate(record)
+        if error:
+            return error
         
-        self.current_data.append(record)
-        self.save_dataset()
+        self._append(record)
+        self._log({'op': 'add', 'record': record})
         return f"Record added: {json.dumps(record)}"
 
-    def save_dataset(self):
-        if self.current_file and self.current_data is not None:
-            with open(self.current_file, 'w') as file:
-                json.dump(self.current_data, file)
-
-    def find_books(self, field, value, operator):
+    @_observed
+    @_syncing
+    def add_records(self, records):
+        """Insert many records in one batch; duplicates and records without a title are skipped."""
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
 
+        titles = None
+        if 'title' not in self.indexes:
+            titles = {existing_record.get('title') for existing_record in self._scan()}
+
+        owns_batch = self._batch is None
+        if owns_batch:
+            self.begin()
+
+        added = skipped = 0
+        error = None
         try:
-            value = float(value)  # Attempt to convert the value to a number for comparison
-        except ValueError:
-            pass  # If conversion fails, keep it as a string
+            for record in records:
+                if not isinstance(record, dict) or 'title' not in record or self._duplicate(record, titles):
+                    skipped += 1
+                    continue
+                self._append(record)
+                self._log({'op': 'add', 'record': record})
+                if titles is not None:
+                    titles.add(record['title'])
+                added += 1
+        except ValueError as invalid:
+            error = invalid  # A malformed NDJSON line ends the input; the records before it still go in
+        finally:
+            # Never leave the batch open, or every later write would only reach memory
+            if owns_batch:
+                self.commit()
+        if error is not None:
+            return f"{error} Stopped there: {added} records added, {skipped} skipped."
+        return f"{added} records added, {skipped} skipped."
 
-        # Applying different conditions based on the operator
-        if operator == '=':
-            matched_books = [record for record in self.current_data if record.get(field) == value]
-        elif operator == '>=':
-            matched_books = [record for record in self.current_data if record.get(field) >= value]
-        elif operator == '>':
-            matched_books = [record for record in self.current_data if record.get(field) > value]
-        elif operator == '<':
-            matched_books = [record for record in self.current_data if record.get(field) < value]
-        elif operator == '<=':
-            matched_books = [record for record in self.current_data if record.get(field) <= value]
+    @_observed
+    @_writing
+    def save_dataset(self):
+        """Checkpoint: write the full dataset to its base file(s) and truncate the log."""
+        if self.current_file and self.current_data is not None:
+            with self._file_lock(self.current_file):
+                self._sync()
+                self._checkpoint()
+                self._synced = _dataset_signature(self.current_file)[0], 0
+
+    def _checkpoint(self):
+        # Queued log entries are already applied in memory, so the base files written here include them
+        with self._queue_lock:
+            self._log_queue = [entry for entry in self._log_queue if entry[1] != self._log_path()]
+        for session in self._batches:
+            self._batches[session] = []  # The base file now holds everything the batches changed
+
+        # Should a crash leave the log behind the new base files, the marker says how much of it they hold
+        marker = self._log_path() + '.checkpoint'
+        if os.path.exists(self._log_path()):
+            with open(marker + '.tmp', 'w') as file:
+                json.dump({'base': list(_dataset_signature(self.current_file)[0]),
+                           'log': os.path.getsize(self._log_path())}, file)
+            os.replace(marker + '.tmp', marker)
+
+        if isinstance(self.current_data, ChunkedData):
+            self.current_data.flush()
+        elif isinstance(self.current_data, BinaryData):
+            write_binary(self.current_file, self.current_data)
+        else:
+            with open(self.current_file + '.tmp', 'w') as file:
+                json.dump(self.current_data, file, default=_plain)
+            os.replace(self.current_file + '.tmp', self.current_file)
+
+        if self.stats is not None:
+            _write_stats(self._stats_path(), self.stats, self.current_file)
+
+        if os.path.exists(self._log_path()):
+            os.remove(self._log_path())
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    def _where(self, field, operator, value, where=None):
+        """Build the condition for a query from either a field/operator/value triple or a WHERE clause."""
+        if where is not None:
+            return parse_condition(where) if isinstance(where, str) else where
+        if field is None and operator is None and value is None:
+            return None
+        return (field, operator, value)
+
+    def _page(self, rows, limit=None, offset=0):
+        """Slice rows lazily; returns None when the page is empty so callers can report no matches."""
+        rows = itertools.islice(rows, offset, None if limit is None else offset + limit)
+        first = next(rows, None)
+        if first is None:
+            return None
+        return itertools.chain([first], rows)
+
+    def _emit(self, rows, out):
+        # Results go straight to out as they are produced, or come back as one JSON string
+        trace = _active_trace()
+        if trace is not None:
+            # Materialize first so serialization time does not include the scan
+            rows = list(rows)
+            start = time.perf_counter()
+        if out is None:
+            text = json.dumps(list(rows), indent=4, default=_plain)
         else:
-            return "Invalid operator."
+            text = None
+            write_json_rows(rows, out)
+        if trace is not None:
+            trace['serialize_seconds'] += time.perf_counter() - start
+        return text
+
+    @_observed
+    @_cached
+    def find_books(self, field, value, operator, where=None, limit=None, offset=0, out=None):
+        if self.current_data is None and self.stream_source is None:
+            return "No dataset loaded. Load a dataset first."
+
+        condition = self._where(field, operator, value, where)
+        with self.lock.read():
+            try:
+                # A LIMIT stops a serial scan early, so only whole-dataset searches fan out; only a serial one is snapshotted
+                parts = self._parallel(condition, 'find') if limit is None and condition is not None else None
+                if parts is not None:
+                    rows = iter([self._rows_of(chunk_index)[position] for part in parts for chunk_index, position in part])
+                else:
+                    rows = self._select(condition, None if limit is None else offset + limit)
+            except ValueError:
+                return "Invalid operator."
+
+        # Filtering and output run on the snapshot without holding the lock
+        matched_books = self._page(rows, limit, offset)
 
-        if not matched_books:
-            return f"No books found with {field} {operator} {value}"
+        if matched_books is None:
+            return f"No books found with {format_condition(condition)}"
 
-        return json.dumps(matched_books, indent=4)
+        return self._emit(matched_books, out)
         
-    def update_record(self, field, new_value, condition_field, condition_operator, condition_value):
+    @_observed
+    @_syncing
+    def update_record(self, field, new_value, condition_field, condition_operator, condition_value, where=None):
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
 
+        condition = self._where(condition_field, condition_operator, condition_value, where)
         try:
-            condition_value = float(condition_value)  # Convert to a number for comparison, if applicable
+            matches = self._matches(condition)
         except ValueError:
-            pass  # If conversion fails, keep it as a string
-
-        operators = {
-            '=': lambda x: x.get(condition_field) == condition_value,
-            '>': lambda x: x.get(condition_field) > condition_value,
-            '<': lambda x: x.get(condition_field) < condition_value,
-            '>=': lambda x: x.get(condition_field) >= condition_value,
-            '<=': lambda x: x.get(condition_field) <= condition_value
-        }
-
-        if condition_operator not in operators:
             return "Invalid condition operator."
 
-        updated = False
-        for record in self.current_data:
-            if operators[condition_operator](record):
-                # Adding a check to ensure the field exists in the record before updating
-                if field in record:
-                    record[field] = new_value
-                    updated = True
-                else:
-                    return f"Field {field} not found in the record."
+        # Adding a check to ensure the field exists in the record before updating
+        if any(field not in record for _, record in matches):
+            return f"Field {field} not found in the record."
+
+        if self._violates_unique(matches, field, new_value):
+            return f"Update would duplicate unique field {field}."
 
+        updated = bool(matches)
         if updated:
-            self.save_dataset()
+            self._set_field(matches, field, new_value)
+            self._log({'op': 'update', 'field': field, 'value': new_value, 'where': condition})
 
-        return "Record updated successfully." if updated else f"No record found with {condition_field} {condition_operator} {condition_value}"
+        return "Record updated successfully." if updated else f"No record found with {format_condition(condition)}"
 
-    def delete_record(self, condition_field, condition_operator, condition_value):
+    @_observed
+    @_syncing
+    def update_by_value(self, field, new_value, condition_field, condition_value):
+        """Set field on every record whose condition_field equals condition_value."""
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
 
-        try:
-            condition_value = float(condition_value)  # Convert to number for comparison if applicable
-        except ValueError:
-            pass
+        condition = (condition_field, '=', condition_value)
+        matches = self._matches(condition)
+        if matches:
+            if isinstance(new_value, str) and new_value.isdigit():
+                new_value = int(new_value)
+            if self._violates_unique(matches, field, new_value):
+                return 0
+            self._set_field(matches, field, new_value)
+            self._log({'op': 'update', 'field': field, 'value': new_value, 'where': condition})
+        return len(matches)
 
-        operators = {
-            '=': lambda x: x.get(condition_field) == condition_value,
-            '>': lambda x: x.get(condition_field) > condition_value,
-            '<': lambda x: x.get(condition_field) < condition_value,
-            '>=': lambda x: x.get(condition_field) >= condition_value,
-            '<=': lambda x: x.get(condition_field) <= condition_value
-        }
+    @_observed
+    @_syncing
+    def delete_record(self, condition_field, condition_operator, condition_value, where=None):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
 
-        if condition_operator not in operators:
+        condition = self._where(condition_field, condition_operator, condition_value, where)
+        try:
+            deleted = self._delete_where(condition)
+        except ValueError:
             return "Invalid condition operator."
 
-        # Get the filtered data
-        filtered_data = list(filter(operators[condition_operator], self.current_data))
-        
-        if not filtered_data:
+        if not deleted:
             return "No books match the provided condition."
-        
-        # Delete the books that match the condition
-        self.current_data = [x for x in self.current_data if x not in filtered_data]
 
-        # Save the updated dataset
-        self.save_dataset()
+        # Log the delete so it is replayed on the next load
+        self._log({'op': 'delete', 'where': condition})
         
-        return f"books matching {condition_field} {condition_operator} {condition_value} have been deleted."
+        return f"books matching {format_condition(condition)} have been deleted."
 
-    def sort_by(self, field, condition_field=None, condition_operator=None, condition_value=None, order='ASC'):
+    @_observed
+    @_cached
+    @_reading
+    def sort_by(self, field, condition_field=None, condition_operator=None, condition_value=None, order='ASC',
+                where=None, limit=None, offset=0, out=None):
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
         
@@ -152,167 +3053,372 @@ class MyLib:
         if order.upper() not in ['ASC', 'DESC']:
             return "Invalid order type. Use ASC or DESC."
         
-        filtered_data = self.current_data
+        condition = None
+        predicate = None
         
         # If a condition is provided, filter the data first before sorting
-        if condition_field and condition_operator and condition_value:
+        if where is not None or (condition_field and condition_operator and condition_value):
+            condition = self._where(condition_field, condition_operator, condition_value, where)
             try:
-                condition_value = float(condition_value)  # Convert to a number for comparison, if applicable
+                predicate = compile_condition(condition)
             except ValueError:
-                pass
-            
-            operators = {
-                '=': lambda x: x.get(condition_field) == condition_value,
-                '>': lambda x: x.get(condition_field) > condition_value,
-                '<': lambda x: x.get(condition_field) < condition_value,
-                '>=': lambda x: x.get(condition_field) >= condition_value,
-                '<=': lambda x: x.get(condition_field) <= condition_value
-            }
-            
-            if condition_operator not in operators:
                 return "Invalid condition operator."
-            
-            filtered_data = list(filter(operators[condition_operator], self.current_data))
-            
-            if not filtered_data:
-                return "No books match the provided condition."
         
-        # Sort the filtered data based on the order type
         if field in ["pages", "isbn"]:
-            sorted_data = sorted(filtered_data, key=lambda x: x.get(field), reverse=(order.upper() == "ASC"))
-        else: sorted_data = sorted(filtered_data, key=lambda x: x.get(field), reverse=(order.upper() == "DESC"))
+            reverse = order.upper() == "ASC"
+        else: reverse = order.upper() == "DESC"
+
+        # A sorted index already holds every row in order, so just walk it
+        index = self._index(field)
+        if isinstance(index, SortedIndex) and not index.excluded:
+            entries = reversed(index.entries) if reverse else index.entries
+            sorted_data = _counted((record for _, record in entries if predicate is None or predicate(record)),
+                                   'rows_matched')
+        else:
+            filtered_data = self._scan()
+            if predicate is not None:
+                filtered_data = _counted(filter(predicate, self._scan(condition)), 'rows_matched')
+            key = lambda x: x.get(field)
+            # Only the first offset + limit rows are needed, so keep a heap of that size instead of sorting everything
+            if limit is not None:
+                top = heapq.nlargest if reverse else heapq.nsmallest
+                sorted_data = top(offset + limit, filtered_data, key=key)
+            else:
+                # Sort the filtered data based on the order type
+                sorted_data = sorted(filtered_data, key=key, reverse=reverse)
+
+        page = self._page(sorted_data, limit, offset)
+        if page is None:
+            if predicate is not None:
+                return "No books match the provided condition."
+            page = iter(())
         
-        return json.dumps(sorted_data, indent=4)
+        return self._emit(page, out)
+
+    def _join_table(self, path, field):
+        """Hash table of the other dataset on field, parsed once and reused while its files are unchanged."""
+        with self._build_lock:
+            signature = _dataset_signature(path)
+            cached = self._join_cache.get(path)
+            if cached is None or cached['signature'] != signature:
+                rows = self._resident_rows(path)
+                if rows is None:
+                    rows = list(stream_dataset(path))
+                cached = {'signature': signature, 'rows': rows, 'tables': {}}
+            self._join_cache[path] = cached
+            self._join_cache.move_to_end(path)
+            while len(self._join_cache) > JOIN_CACHE_SIZE:
+                self._join_cache.popitem(last=False)
+
+            if field not in cached['tables']:
+                table = {}
+                for record in cached['rows']:
+                    key = _join_key(record, field)
+                    if key is not None:
+                        table.setdefault(key, []).append(record)
+                cached['tables'][field] = table
+            return cached['tables'][field]
+
+    def iter_join(self, other_dataset, field, mode='inner'):
+        """
+        Yield joined rows of the current dataset ("self") with other_dataset:
+        {'self': ..., 'other': ...} pairs for inner and left joins, and the
+        matching self records for a semi join. The hash table is built on the
+        smaller side and the larger side is streamed past it.
+        """
+        path = dataset_path(other_dataset)
+        cached = self._join_cache.get(path)
+        if (cached is not None and cached['signature'] == _dataset_signature(path)) \
+                or path in self.catalog or _dataset_bytes(path) <= _dataset_bytes(self.current_file):
+            yield from self._probe_other_table(self._join_table(path, field), field, mode)
+        else:
+            yield from self._probe_other_stream(stream_dataset(path), field, mode)
+
+    def _probe_other_table(self, table, field, mode):
+        for left in self._scan():
+            key = _join_key(left, field)
+            matches = table.get(key) if key is not None else None
+            if mode == 'semi':
+                if matches:
+                    yield left
+            elif matches:
+                for right in matches:
+                    yield {'self': left, 'other': right}
+            elif mode == 'left':
+                yield {'self': left, 'other': None}
+
+    def _probe_other_stream(self, rows, field, mode):
+        table = {}
+        for left in self._scan():
+            key = _join_key(left, field)
+            if key is not None:
+                table.setdefault(key, []).append(left)
+
+        matched = set()
+        for right in rows:
+            key = _join_key(right, field)
+            for left in table.get(key, ()) if key is not None else ():
+                if mode == 'semi':
+                    if id(left) not in matched:
+                        matched.add(id(left))
+                        yield left
+                    continue
+                matched.add(id(left))
+                yield {'self': left, 'other': right}
 
-    def join(self, other_dataset, field):
+        if mode == 'left':
+            for left in self._scan():
+                if id(left) not in matched:
+                    yield {'self': left, 'other': None}
+
+    @_observed
+    @_cached
+    @_reading
+    def join(self, other_dataset, field, mode='inner', out=None):
+        """Join with other_dataset; writes rows to out as they are produced when given, else returns them as JSON."""
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
 
-        if not os.path.exists(other_dataset + '.json'):
+        if dataset_path(other_dataset) is None:
             return f"File {other_dataset}.json not found!"
 
-        with open(other_dataset + '.json', 'r') as file:
-            other_data = json.load(file)
+        mode = mode.lower()
+        if mode not in JOIN_MODES:
+            return f"Invalid join type. Use {', '.join(mode.upper() for mode in JOIN_MODES)}."
+
+        if mode == 'group':
+            return self._group_join(other_dataset, field)
 
+        return self._emit(self.iter_join(other_dataset, field, mode), out)
+
+    def _group_join(self, other_dataset, field):
         joined_data = {}
 
         # Add records from the first dataset
-        for record in self.current_data:
+        for record in self._scan():
             key_value = record.get(field)
             if key_value not in joined_data:
                 joined_data[key_value] = {'self': [], 'other': []}
             joined_data[key_value]['self'].append(record)
 
         # Add records from the second dataset
-        for record in other_data:
+        for record in stream_dataset(dataset_path(other_dataset)):
             key_value = record.get(field)
             if key_value not in joined_data:
                 joined_data[key_value] = {'self': [], 'other': []}
             joined_data[key_value]['other'].append(record)
 
-        return json.dumps(joined_data, indent=4)
+        return json.dumps(joined_data, indent=4, default=_plain)
 
-    def count(self, field, operator, value):
+    @_observed
+    @_cached
+    def count(self, field, operator, value, where=None):
         
-        if self.current_data is None:
+        if self.current_data is None and self.stream_source is None:
             return "No dataset loaded. Load a dataset first."
         
-        print(field, operator, value)
+        condition = self._where(field, operator, value, where)
+        if condition is None and self.stream_source is None:
+            return f"Total Records {len(self.current_data)}"
+
+        try:
+            compile_condition(condition)
+        except ValueError:
+            return "Invalid condition operator."
+
+        with self.lock.read():
+            mask = self._mask(condition) if self._columnar(condition) else None
+            if mask is not None:
+                _note('rows_scanned', len(mask))
+                _note('rows_matched', int(mask.sum()))
+                return f"Total Records {int(mask.sum())}"
+
+            parts = self._parallel(condition, 'count')
+            if parts is not None:
+                return f"Total Records {sum(parts)}"
+
+            rows = self._select(condition)
+
         count = 0
-        if operator==None and value==None and field==None:
-            for row in self.current_data:
-                count += 1
-            return f"Total Records {count}"
-        else:
-            for row in self.current_data:
-                if operator == "=": 
-                    if str(row[field]) == value: count += 1
-                elif operator == ">=": 
-                    if str(row[field]) >= value: count += 1
-                elif operator == "<=": 
-                    if str(row[field]) <= value: count += 1
-                elif operator == "!=": 
-                    if str(row[field]) != value: count += 1
-                else: continue
-                
-            return f"Total Records {count}"
+        for _ in rows:
+            count += 1
+        return f"Total Records {count}"
             
-    def sum(self, field, operator, value):
+    @_observed
+    @_cached
+    def sum(self, field, operator, value, where=None):
         
-        if self.current_data is None:
+        if self.current_data is None and self.stream_source is None:
             return "No dataset loaded. Load a dataset first."
         
+        condition = self._where(field, operator, value, where)
+        try:
+            compile_condition(condition)
+        except ValueError:
+            return "Invalid condition operator."
+
+        with self.lock.read():
+            if condition is None and self.stream_source is None:
+                pages = self._stats().numeric("pages")
+                if pages is not None:
+                    return f"Total Pages {pages['sum']}"
+
+            columns = self._columns_where(["pages"], condition)
+            if columns is not None:
+                return f"Total Pages {columns[0].sum().item()}"
+
+            parts = self._parallel(condition, 'sum')
+            if parts is not None:
+                return f"Total Pages {sum(parts)}"
+
+            rows = self._select(condition)
+
         sum_pages = 0
-        if operator==None and value==None and field==None:
-            for row in self.current_data:
-                sum_pages += row["pages"]
-            return f"Total Pages {sum_pages}"
-        else:
-            for row in self.current_data:
-                if operator == "=": 
-                    if str(row[field]) == value: sum_pages += row["pages"]
-                elif operator == ">=": 
-                    if str(row[field]) >= value: sum_pages += row["pages"]
-                elif operator == "<=": 
-                    if str(row[field]) <= value: sum_pages += row["pages"]
-                elif operator == "!=": 
-                    if str(row[field]) != value: sum_pages += row["pages"]
-                else: continue
-                
-            return f"Total Pages {sum_pages}"
+        for row in rows:
+            sum_pages += row["pages"]
+        return f"Total Pages {sum_pages}"
         
-    def average(self, field, operator, value):
-        if self.current_data is None:
+    @_observed
+    @_cached
+    def average(self, field, operator, value, where=None):
+        if self.current_data is None and self.stream_source is None:
             return "No dataset loaded. Load a dataset first."
         
+        condition = self._where(field, operator, value, where)
+        try:
+            compile_condition(condition)
+        except ValueError:
+            return "Invalid condition operator."
+
+        with self.lock.read():
+            if condition is None and self.stream_source is None:
+                stats = self._stats()
+                pages, years = stats.numeric("pages"), stats.numeric("publishedYear")
+                if pages is not None and years is not None and stats.rows:
+                    page_average = pages['sum'] / stats.rows
+                    publishedYear_average = years['sum'] / stats.rows
+                    return f"--- Page AVG: {page_average}\t\n--- Published Year AVG: {publishedYear_average}"
+
+            columns = self._columns_where(["pages", "publishedYear"], condition)
+            if columns is not None:
+                pages, years = columns
+                if not len(pages):
+                    return "No books match the provided condition."
+                if condition is not None:
+                    pages, years = np.trunc(pages), np.trunc(years)
+                page_average = pages.sum().item() / len(pages)
+                publishedYear_average = years.sum().item() / len(years)
+                return f"--- Page AVG: {page_average}\t\n--- Published Year AVG: {publishedYear_average}"
+
+            parts = self._parallel(condition, 'average')
+            rows = self._select(condition) if parts is None else None
+
         page_average = 0
         publishedYear_average = 0
         count = 0
-
-        if operator==None and value==None and field==None:
-            for row in self.current_data:
-                publishedYear_average += row["publishedYear"]
-                page_average += row["pages"]
-                count += 1
+        if parts is not None:
+            for part_count, part_pages, part_years in parts:
+                count += part_count
+                page_average += part_pages
+                publishedYear_average += part_years
         else:
-            for row in self.current_data:
-                if operator == "=": 
-                    if str(row[field]) == value: 
-                        publishedYear_average += int(row["publishedYear"])
-                        page_average += int(row["pages"])
-                elif operator == ">=": 
-                    if str(row[field]) >= value: 
-                        publishedYear_average += int(row["publishedYear"])
-                        page_average += int(row["pages"])
-                elif operator == "<=": 
-                    if str(row[field]) <= value: 
-                        publishedYear_average += int(row["publishedYear"])
-                        page_average += int(row["pages"])
-                elif operator == "!=": 
-                    if str(row[field]) != value: 
-                        publishedYear_average += int(row["publishedYear"])
-                        page_average += int(row["pages"])
-                else: continue
+            number = _average_number(condition)
+            for row in rows:
+                publishedYear_average += number(row["publishedYear"])
+                page_average += number(row["pages"])
                 count += 1
+
+        if not count:
+            return "No books match the provided condition."
             
         page_average = page_average/count
         publishedYear_average = publishedYear_average/count
             
         return f"--- Page AVG: {page_average}\t\n--- Published Year AVG: {publishedYear_average}"  
 
+    @_observed
+    @_cached
+    def group_by(self, keys, aggregates, where=None, limit=None, offset=0, out=None):
+        """
+        Group the rows matching where by the keys fields and compute every
+        aggregate, a list of (COUNT|SUM|AVG|MIN|MAX, field) pairs, in one pass.
+        COUNT with no field counts rows; the others use numeric values only.
+        """
+        if self.current_data is None and self.stream_source is None:
+            return "No dataset loaded. Load a dataset first."
+
+        try:
+            condition = self._where(None, None, None, where)
+            compile_condition(condition)
+        except ValueError:
+            return "Invalid condition operator."
+
+        keys = list(keys)
+        fields = sorted({field for _, field in aggregates if field is not None})
+        results = self._page(_group_results(self._groups(keys, fields, condition), keys, aggregates), limit, offset)
+        if results is None:
+            return "No books match the provided condition."
+        return self._emit(results, out)
+
+    def _groups(self, keys, fields, condition):
+        """The hash aggregation table of the rows matching condition; shards send theirs for merging."""
+        with self.lock.read():
+            parts = self._parallel(condition, ('group', tuple(keys), tuple(fields)))
+            rows = self._select(condition) if parts is None else None
+
+        if parts is None:
+            return _group_rows(rows, keys, fields)
+        groups = {}
+        for part in parts:
+            _merge_groups(groups, part)
+        return groups
+
+    @_observed
+    @_cached
+    @_reading
     def Max(self):
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
         
+        pages = self._stats().numeric("pages")
+        if pages is not None:
+            maximum = max(0, pages['max']) if pages['count'] else 0
+            return f"--- Book With Maximum Pages: {maximum}"
+
+        index = self._index("pages")
+        if isinstance(index, SortedIndex) and not index.excluded:
+            maximum = max(0, index.keys[-1]) if index.keys else 0
+            return f"--- Book With Maximum Pages: {maximum}"
+
+        columns = self._columns_where(["pages"], None)
+        if columns is not None:
+            maximum = max(0, columns[0].max().item()) if len(columns[0]) else 0
+            return f"--- Book With Maximum Pages: {maximum}"
+
         maximum = 0
         for row in self.current_data:
             if row["pages"] > maximum: maximum = row["pages"]
         return f"--- Book With Maximum Pages: {maximum}"
     
+    @_observed
+    @_cached
+    @_reading
     def minimum(self):
         if self.current_data is None:
             return "No dataset loaded. Load a dataset first."
         
+        pages = self._stats().numeric("pages")
+        if pages is not None and pages['count']:
+            return f"--- Book With Miimum Pages: {pages['min']}"
+
+        index = self._index("pages")
+        if isinstance(index, SortedIndex) and not index.excluded and index.keys:
+            return f"--- Book With Miimum Pages: {index.keys[0]}"
+
+        columns = self._columns_where(["pages"], None)
+        if columns is not None and len(columns[0]):
+            return f"--- Book With Miimum Pages: {columns[0].min().item()}"
+
         minimum = self.current_data[0]["pages"]
         for row in self.current_data:
             if row["pages"] < minimum: minimum = row["pages"]
@@ -322,17 +3428,82 @@ class MyLibShell(cmd.Cmd):
     intro = 'Welcome to the MyLib shell. Type help or ? to list commands.\n'
     prompt = 'MyLib > '
 
-    def __init__(self):
+    def __init__(self, db=None):
         super(MyLibShell, self).__init__()
-        self.db = MyLib()
+        self.db = db if db is not None else MyLib()
 
     def do_create(self, arg):
-        """Create a new dataset: CREATE <filename>"""
+        """Create a new dataset or index: CREATE <filename> | CREATE [UNIQUE|SORTED|TEXT] INDEX <field>"""
         if not arg:
             print("Usage: CREATE <filename>")
             return
+
+        args = arg.split()
+        modifier = args[0].upper() if args[0].upper() in ['UNIQUE', 'SORTED', 'TEXT'] else None
+        if modifier:
+            args = args[1:]
+        if args and args[0].upper() == 'INDEX':
+            if len(args) != 2:
+                print("Usage: CREATE [UNIQUE|SORTED|TEXT] INDEX <field>")
+                return
+            kind = modifier.lower() if modifier in ('SORTED', 'TEXT') else 'hash'
+            print(self.db.create_index(args[1], modifier == 'UNIQUE', kind))
+            return
+
         print(self.db.create_dataset(arg))
 
+    def do_drop(self, arg):
+        """Drop an index: DROP INDEX <field>"""
+        args = arg.split()
+        if len(args) != 2 or args[0].upper() != 'INDEX':
+            print("Usage: DROP INDEX <field>")
+            return
+        print(self.db.drop_index(args[1]))
+
+    def do_chunk(self, arg):
+        """Split a single-file dataset into chunk files: CHUNK <filename> [chunk_size]"""
+        args = arg.split()
+        if len(args) not in [1, 2] or (len(args) == 2 and not args[1].isdigit()):
+            print("Usage: CHUNK <filename> [chunk_size]")
+            return
+        chunk_size = int(args[1]) if len(args) == 2 else CHUNK_SIZE
+        print(self.db.chunk_dataset(args[0], chunk_size))
+
+    def do_convert(self, arg):
+        """Change a dataset's storage format: CONVERT <dataset> TO binary|json"""
+        args = arg.split()
+        if len(args) != 3 or args[1].upper() != 'TO':
+            print("Usage: CONVERT <dataset> TO binary|json")
+            return
+        print(self.db.convert_dataset(args[0], args[2]))
+
+    def do_datasets(self, arg):
+        """List the open datasets, the current one marked with *: DATASETS"""
+        print(self.db.datasets())
+
+    def do_close(self, arg):
+        """Forget an open dataset so it no longer uses memory: CLOSE <dataset>"""
+        if not arg:
+            print("Usage: CLOSE <dataset>")
+            return
+        print(self.db.close_dataset(arg))
+
+    def do_budget(self, arg):
+        """Memory for open datasets before the least recently used are closed: BUDGET <megabytes> | BUDGET OFF"""
+        if arg.strip().upper() == 'OFF':
+            print(self.db.set_memory_budget(None))
+        elif arg.strip().isdigit():
+            print(self.db.set_memory_budget(int(arg)))
+        else:
+            print("Usage: BUDGET <megabytes> | BUDGET OFF")
+
+    def do_compact(self, arg):
+        """Keep loaded records as compact shared-schema rows instead of dicts: COMPACT ON|OFF"""
+        if arg.strip().upper() in ('ON', 'OFF'):
+            print(self.db.set_compact(arg.strip().upper() == 'ON'))
+        else:
+            print("Usage: COMPACT ON|OFF")
+
     def do_load(self, arg):
         """Load a dataset: LOAD <filename>"""
         if not arg:
@@ -341,51 +3512,50 @@ class MyLibShell(cmd.Cmd):
         print(self.db.load_dataset(arg))
 
     def do_add(self, arg):
-        """Add a new record: ADD <record_as_json>"""
+        """Add records: ADD <record_as_json> | ADD [<record>, ...] | ADD <file.ndjson>"""
         if not arg:
             print("Usage: ADD <record_as_json>")
             return
+        arg = arg.strip()
         try:
+            if not arg.startswith(('{', '[')) and os.path.isfile(arg):
+                print(self.db.add_records(iter_ndjson(arg)))
+                return
             record = json.loads(arg)
-            print(self.db.add_record(record))
+            if isinstance(record, list):
+                print(self.db.add_records(record))
+            else:
+                print(self.db.add_record(record))
         except json.JSONDecodeError:
             print("Invalid JSON format.")
 
+    def do_begin(self, line):
+        """Start a batch; changes are written to disk together on COMMIT"""
+        print(self.db.begin())
+
+    def do_commit(self, line):
+        """Write all changes made since BEGIN"""
+        print(self.db.commit())
+
     def do_find(self, line):
-        """Find books with a specific condition, e.g., FIND books whose age is 30"""
-        if self.db.current_data is None:
+        """Find books with a specific condition, e.g., FIND books whose age is 30 or FIND books whose title contains dragon fire*"""
+        if self.db.current_data is None and self.db.stream_source is None:
             print("No dataset loaded. Load a dataset first.")
             return
 
         try:
+            line, limit, offset, target = _page_clause(line)
             # Extracting condition from the line
             condition = re.search(r"books whose (.+)", line)
             if condition:
-                condition = condition.group(1).strip()
-                operator = None
-                
-                if 'at least' in condition:
-                    field, _, value = condition.partition(' at least ')
-                    operator = '>='
-                elif 'is' in condition:
-                    field, _, value = condition.partition(' is ')
-                    operator = '='
-                elif 'greater than' in condition:
-                    field, _, value = condition.partition(' greater than ')
-                    operator = '>'
-                elif 'less than' in condition:
-                    field, _, value = condition.partition(' less than ')
-                    operator = '<'
-                elif 'at most' in condition:
-                    field, _, value = condition.partition(' at most ')
-                    operator = '<='
-                else:
+                try:
+                    where = parse_condition(condition.group(1).strip(), _parse_phrase)
+                except ValueError:
                     print("Invalid condition format.")
                     return
                 
-                results = self.db.find_books(field.strip(), value.strip(), operator)
-                print("Matching books:")
-                print(results)
+                self._write_results("Matching books:", target, lambda out: self.db.find_books(
+                    None, None, None, where=where, limit=limit, offset=offset, out=out))
             else:
                 print("Invalid query format. Use: FIND books whose <condition>")
         except Exception as e:
@@ -412,19 +3582,11 @@ class MyLibShell(cmd.Cmd):
             update_value = update_value.strip(' "')
             condition_value = condition_value.strip(' "')
             
-            updated_count = 0
-            for record in self.db.current_data:
-                if str(record.get(condition_field)) == condition_value:
-                    if update_value.isdigit():
-                        update_value = int(update_value)
-                    record[update_field] = update_value
-                    updated_count += 1
-            
+            updated_count = self.db.update_by_value(update_field, update_value, condition_field, condition_value)
             if updated_count == 0:
                 print("No books updated.")
                 return
             
-            self.db.save_dataset()
             print(f"{updated_count} books updated.")
         except Exception as e:
             print(f"Error updating books: {e}")
@@ -432,134 +3594,124 @@ class MyLibShell(cmd.Cmd):
     def do_delete(self, line):
         """
         Delete books with a specific condition: 
-        DELETE WHERE <condition_field> <condition_operator> <condition_value>
+        DELETE WHERE <condition_field> <condition_operator> <condition_value> [AND|OR ...]
         """
         
-        args = line.split()
-        if args[1] not in ["pages", "isbn", "publishedYear", "publishedDate"]: 
-            args[3] = " ".join(args[3:])
-            args = args[:4]
-            
-        print(args)
-        if len(args) != 4 or args[0].upper() != 'WHERE':
+        args = line.split(None, 1)
+        if len(args) != 2 or args[0].upper() != 'WHERE':
             print("Usage: DELETE WHERE <condition_field> <condition_operator> <condition_value>")
             return
 
-        condition_field = args[1]
-        condition_operator = args[2]
-        condition_value = args[3]
-
-        print(len(line.split()))
+        try:
+            where = parse_condition(args[1])
+        except ValueError as e:
+            print(e)
+            return
         
-        print(self.db.delete_record(condition_field, condition_operator, condition_value))
+        print(self.db.delete_record(None, None, None, where=where))
 
     def do_sortby(self, line):
         """
         Sort books by a specific attribute in ascending or descending order 
         based on a given condition: 
         SORTBY <field> [ASC|DESC] WHERE <condition_field> <condition_operator> <condition_value>
+        [LIMIT <n> [OFFSET <m>]] [INTO <file>]
         """
-        args = line.split()
-        if len(args) not in [1, 2, 6] or (len(args) == 6 and args[2].upper() != 'WHERE'):
+        line, limit, offset, target = _page_clause(line)
+        parts = re.split(r'\s+WHERE\s+', line.strip(), maxsplit=1, flags=re.IGNORECASE)
+        args = parts[0].split()
+        if len(args) not in [1, 2]:
             print("Usage: SORTBY <field> [order] WHERE <condition_field> <condition_operator> <condition_value>")
             return
         
         field = args[0]
-        try: order = args[1]
-        except: order = 'ASC'
+        order = args[1] if len(args) == 2 else 'ASC'
     
-        condition_field = condition_operator = condition_value = None
-        
-        if len(args) > 2:
-            order = args[1]
-            condition_field = args[3]
-            condition_operator = args[4]
-            condition_value = args[5]
+        where = None
+        if len(parts) == 2:
+            try:
+                where = parse_condition(parts[1])
+            except ValueError as e:
+                print(e)
+                return
         
-        print(self.db.sort_by(field, condition_field, condition_operator, condition_value, order))
+        self._write_results(None, target, lambda out: self.db.sort_by(
+            field, order=order, where=where, limit=limit, offset=offset, out=out))
+
+    def _write_results(self, heading, target, run):
+        """Stream a query's rows to stdout, or to the file named by INTO."""
+        if target is None:
+            if heading and not self.db.explaining:
+                print(heading)
+            error = run(sys.stdout)
+            if error:
+                print(error)
+            return
+
+        with open(target, 'w') as file:
+            error = run(file)
+        print(error or f"Results written to {target}.")
 
     def do_join(self, line):
-        # """Join current data with another dataset by a specific field: JOIN <other_dataset> <field>"""
+        """Join current data with another dataset by a specific field: JOIN <other_dataset> <field> [INNER|LEFT|SEMI|GROUP]"""
         args = line.split()
-        if len(args) != 2:
-            print("Usage: JOIN <other_dataset> <field>")
+        if len(args) not in [2, 3]:
+            print("Usage: JOIN <other_dataset> <field> [INNER|LEFT|SEMI|GROUP]")
+            return
+        other_dataset, field = args[:2]
+        mode = args[2] if len(args) == 3 else 'inner'
+        if mode.lower() == 'group':
+            result = self.db.join(other_dataset, field, mode)
+            print(f"Joined Data:\n{result}")
             return
-        other_dataset, field = args
-        print("Joined Data:")
-        print(self.db.join(other_dataset, field))
 
-    def do_count(self, line):
-        args = line.split()
+        if not self.db.explaining:
+            print("Joined Data:")
+        error = self.db.join(other_dataset, field, mode, out=sys.stdout)
+        if error:
+            print(error)
 
-        field=None, 
-        operator = None,
-        value = None
-        
-        try: 
-            field = field[0]
-            operator = operator[0]
-        except: pass
-        
+    def _aggregate_where(self, line, usage):
+        """Parse "book [WHERE <condition>]"; returns (ok, condition)."""
+        args = line.split(None, 2)
         if len(args) == 1:
-            pass
-        elif len(args) == 5:
-            field, operator, value = args[2], args[3], args[4]
-        else:
-            print("Usage: COUNT book WHERE <condition_field> <condition_operator> <condition_value>")
-            return
-        
-        print(self.db.count(field, operator, value))
+            return True, None
+        if len(args) == 3 and args[1].upper() == 'WHERE':
+            try:
+                return True, parse_condition(args[2])
+            except ValueError:
+                pass
+        print(usage)
+        return False, None
 
-    def do_sum(self, line):
-        args = line.split()
+    def do_count(self, line):
+        ok, where = self._aggregate_where(line, "Usage: COUNT book WHERE <condition_field> <condition_operator> <condition_value>")
+        if ok:
+            print(self.db.count(None, None, None, where=where))
 
-        field=None, 
-        operator = None,
-        value = None
-        
-        try: 
-            field = field[0]
-            operator = operator[0]
-        except: pass
-        
-        if len(args) == 1:
-            pass
-        elif len(args) == 5:
-            field, operator, value = args[2], args[3], args[4]
-        elif len(args) > 5:
-            field, operator, value = args[2], args[3], ' '.join(args[4:])
-        else:
-            print("Usage: SUM book WHERE <condition_field> <condition_operator> <condition_value>")
-            return
-        
-        print(self.db.sum(field, operator, value))
+    def do_sum(self, line):
+        ok, where = self._aggregate_where(line, "Usage: SUM book WHERE <condition_field> <condition_operator> <condition_value>")
+        if ok:
+            print(self.db.sum(None, None, None, where=where))
     
     def do_average(self, line):
-        args = line.split()
-
-        field= None, 
-        operator = None,
-        value = None
-        
-        try: 
-            field = field[0]
-            operator = operator[0]
-        except: pass
-        
-        if len(args) == 1:
-            pass
-        elif len(args) == 5:
-            field, operator, value = args[2], args[3], args[4]
-            print(field, operator, value)
-        elif len(args) > 5:
-            field, operator, value = args[2], args[3], ' '.join(args[4:])
-            print(field, operator, value)
-        else:
-            print("Usage: AVERAGE book WHERE <condition_field> <condition_operator> <condition_value>")
+        ok, where = self._aggregate_where(line, "Usage: AVERAGE book WHERE <condition_field> <condition_operator> <condition_value>")
+        if ok:
+            print(self.db.average(None, None, None, where=where))
+    
+    def do_select(self, line):
+        """Aggregate per group in one pass: SELECT <field|COUNT|SUM f|AVG f|MIN f|MAX f>, ... [GROUP BY <fields>] [WHERE <condition>] [LIMIT <n> [OFFSET <m>]] [INTO <file>]"""
+        usage = "Usage: SELECT <field|COUNT|SUM f|AVG f|MIN f|MAX f>, ... [GROUP BY <fields>] [WHERE <condition>]"
+        line, limit, offset, target = _page_clause(line)
+        try:
+            keys, aggregates, where = parse_select(line)
+            where = parse_condition(where) if where else None
+        except ValueError as error:
+            print(f"{error}\n{usage}")
             return
+        self._write_results("Groups:", target,
+                            lambda out: self.db.group_by(keys, aggregates, where, limit, offset, out=out))
 
-        print(self.db.average(field, operator, value))
-    
     def do_max(self, line):
         args = line.split()
 
@@ -593,10 +3745,1007 @@ class MyLibShell(cmd.Cmd):
 
         print(self.db.minimum())
             
+    def do_columns(self, line):
+        """Cache more numeric fields as NumPy columns: COLUMNS <field> [<field> ...]"""
+        args = line.split()
+        if not args:
+            print("Usage: COLUMNS <field> [<field> ...]")
+            return
+        print(self.db.cache_columns(*args))
+
+    def do_parallel(self, line):
+        """Scan with worker processes from this many rows up: PARALLEL <rows> [<workers>] | PARALLEL OFF"""
+        args = line.split()
+        if args == ['OFF'] or args == ['off']:
+            print(self.db.set_parallel(None))
+        elif len(args) in [1, 2] and all(arg.isdigit() for arg in args):
+            print(self.db.set_parallel(*map(int, args)))
+        else:
+            print("Usage: PARALLEL <rows> [<workers>] | PARALLEL OFF")
+
+    def do_checkpoint(self, line):
+        """Fold the write-ahead log into the dataset files: CHECKPOINT"""
+        if self.db.current_data is None:
+            print("No dataset loaded. Load a dataset first.")
+            return
+        self.db.save_dataset()
+        print(f"Dataset {self.db.current_file} checkpointed.")
+
+    def do_stream(self, line):
+        """
+        Run FIND, COUNT, SUM or AVERAGE by streaming a dataset from disk
+        without loading it: STREAM <dataset> <command>
+        """
+        args = line.split(None, 1)
+        if len(args) != 2:
+            print("Usage: STREAM <dataset> <command>")
+            return
+        if self.parseline(args[1])[0] not in STREAM_COMMANDS:
+            print(f"STREAM runs {', '.join(command.upper() for command in STREAM_COMMANDS)}.")
+            return
+
+        message = self.db.open_stream(args[0])
+        if self.db.stream_source is None:
+            print(message)
+            return
+        try:
+            self.onecmd(args[1])
+        finally:
+            self.db.close_stream()
+
+    def do_explain(self, line):
+        """Show which access path a command would take, without running it: EXPLAIN <command>"""
+        if not line:
+            print("Usage: EXPLAIN <command>")
+            return
+        command, rest, _ = self.parseline(line)
+        while command == 'stream' and len(rest.split(None, 1)) == 2:
+            command, rest, _ = self.parseline(rest.split(None, 1)[1])
+        if command not in EXPLAINABLE_COMMANDS:
+            print(f"EXPLAIN only plans {', '.join(sorted(EXPLAINABLE_COMMANDS)).upper()}.")
+            return
+        self.db.explaining = True
+        try:
+            self.onecmd(line)
+        except Explained as explained:
+            print(explained.plan)
+        else:
+            print("Nothing to explain: the command did not reach a dataset operation.")
+        finally:
+            self.db.explaining = False
+
+    def do_profile(self, line):
+        """Run a command and report its wall time, rows scanned and matched, bytes read and serialization time"""
+        if not line:
+            print("Usage: PROFILE <command>")
+            return
+        with tracing() as trace:
+            start = time.perf_counter()
+            self.onecmd(line)
+            seconds = time.perf_counter() - start
+        print(f"--- Wall time: {seconds:.6f}s")
+        print(f"--- Rows scanned: {trace['rows_scanned']}")
+        print(f"--- Rows matched: {trace['rows_matched']}")
+        print(f"--- Bytes read: {trace['bytes_read']}")
+        print(f"--- Serialization time: {trace['serialize_seconds']:.6f}s")
+        print(f"--- Result cache hits: {trace['cache_hits']}")
+
+    def do_metrics(self, line):
+        """Show per-operation call counts, latency histograms and counters: METRICS"""
+        recorders = [hook for hook in self.db.hooks if isinstance(hook, MetricsRecorder)]
+        if not recorders:
+            print("No metrics are being recorded.")
+            return
+        print(json.dumps(recorders[0].to_json(), indent=4))
+
     def do_exit(self, line):
         """Exit the shell"""
         print("Exiting...")
         return True
 
+
+def _tcp_address(address):
+    # host:port is a TCP address; anything else is a Unix socket path
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return None
+
+
+def _reply(text):
+    payload = text.encode()
+    return f"{len(payload)}\n".encode() + payload
+
+
+class _SessionOutput:
+    """sys.stdout while serving: a command's prints go to the buffer of the session whose thread runs it."""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def write(self, text):
+        return getattr(self.local, 'buffer', self.default).write(text)
+
+    def flush(self):
+        getattr(self.local, 'buffer', self.default).flush()
+
+
+class _Libraries:
+    """
+    The server's MyLibs, one per dataset path, shared by every session that
+    has that dataset loaded. A session's LOAD moves it to the MyLib of the
+    dataset, so each session keeps its own current dataset; None is the
+    MyLib of sessions that have not loaded one yet.
+    """
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.libraries = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            db = self.libraries.get(path)
+            if db is None:
+                db = self.libraries[path] = MyLib()
+                db.add_hook(self.hook)
+            return db
+
+    def all(self):
+        with self.lock:
+            return list(self.libraries.values())
+
+
+def _run_session_command(libraries, shell, line):
+    """Run one command line of a session in a worker thread; returns (output, stop)."""
+    command, arg, _ = shell.parseline(line)
+    if command == 'load' and arg:
+        path = dataset_path(arg.strip())
+        if path is not None:
+            shell.db = libraries.get(path)
+    output = io.StringIO()
+    shell.stdout = output
+    sys.stdout.local.buffer = output
+    try:
+        # The shell stands for the session: its BEGIN ... COMMIT batch is not shared with other clients
+        with shell.db.session(shell):
+            stop = shell.onecmd(line)
+    except Exception as error:
+        print(f"Error: {error}")
+        stop = False
+    finally:
+        del sys.stdout.local.buffer
+    return output.getvalue(), stop
+
+
+async def _serve_client(libraries, reader, writer):
+    # Each client gets its own shell; commands run in worker threads so a slow one does not hold up other clients
+    shell = MyLibShell(libraries.get(None))
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            output, stop = await loop.run_in_executor(
+                None, _run_session_command, libraries, shell, line.decode().rstrip('\r\n'))
+            writer.write(_reply(output))
+            await writer.drain()
+            if stop:
+                break
+    finally:
+        writer.close()
+        for db in libraries.all():
+            await loop.run_in_executor(None, db.end_session, shell)
+
+
+def serve(address=SERVER_ADDRESS):
+    """Keep datasets resident and answer shell commands from many clients on a TCP or Unix socket."""
+    libraries = _Libraries(MetricsRecorder())
+
+    async def run():
+        handler = lambda reader, writer: _serve_client(libraries, reader, writer)
+        tcp = _tcp_address(address)
+        if tcp is None:
+            server = await asyncio.start_unix_server(handler, address)
+        else:
+            server = await asyncio.start_server(handler, *tcp)
+        print(f"MyLib server listening on {address}")
+        async with server:
+            await server.serve_forever()
+
+    stdout, sys.stdout = sys.stdout, _SessionOutput(sys.stdout)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = stdout
+
+
+class RemoteShell(MyLibShell):
+    """
+    MyLibShell whose commands run on a MyLib server. Parsing, HELP and EXIT
+    stay local; every other command line is sent as-is and its output printed.
+    """
+    intro = 'Connected to the MyLib server. Type help or ? to list commands.\n'
+
+    def __init__(self, address=SERVER_ADDRESS):
+        super(RemoteShell, self).__init__()
+        tcp = _tcp_address(address)
+        if tcp is None:
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.connect(address)
+        else:
+            self.connection = socket.create_connection(tcp)
+        self.replies = self.connection.makefile('rb')
+
+    def request(self, line):
+        self.connection.sendall(line.encode() + b'\n')
+        length = int(self.replies.readline())
+        return self.replies.read(length).decode()
+
+    def onecmd(self, line):
+        command, arg, line = self.parseline(line)
+        if not line:
+            return self.emptyline()
+        if command in ('help', 'exit') or command is None or not hasattr(self, 'do_' + command):
+            return super(RemoteShell, self).onecmd(line)
+        self.lastcmd = line
+        print(self.request(line), end='')
+
+    def postloop(self):
+        self.connection.close()
+
+
+# Shell commands whose parse ends in exactly one MyLib call, so that call can stand for the whole command
+BATCH_PREPARED = ('find', 'count', 'sum', 'average', 'max', 'min', 'sortby', 'select', 'update', 'delete', 'join', 'load')
+_SHAPE_SPLIT = re.compile(r'([\s"(),=<>!]+)')
+_SHAPE_KEYWORDS = frozenset([
+    'BOOK', 'BOOKS', 'WHOSE', 'IS', 'NOT', 'AT', 'LEAST', 'MOST', 'GREATER', 'LESS', 'THAN', 'CONTAINS',
+    'WHERE', 'AND', 'OR', 'LIMIT', 'OFFSET', 'INTO', 'ASC', 'DESC', 'GROUP', 'BY', 'INNER', 'LEFT', 'SEMI',
+    'COUNT', 'SUM', 'AVG', 'MIN', 'MAX'])
+# A value in a shape's pattern: a whole word that is not a keyword
+_VALUE_GROUP = (r'((?!(?i:' + '|'.join(sorted(_SHAPE_KEYWORDS)) + r')(?![^\s"(),=<>!]))[^\s"(),=<>!]+)')
+_PARAM_PATTERN = re.compile(r'__param(\d+)__')
+
+
+def command_shape(line):
+    """
+    Split a command line into its shape and its distinct values. The shape is
+    the line with each value word replaced by __param<n>__, n indexing the
+    values; the command, keywords, operators and LIMIT/OFFSET/INTO arguments
+    stay. Also returns a regex matching exactly the lines of this shape, with
+    their values as its groups.
+    """
+    pieces = _SHAPE_SPLIT.split(line)  # Words at even positions, separators between them
+    params, numbers, pattern = [], {}, []
+    keep = True  # The command itself
+    for position, piece in enumerate(pieces):
+        if position % 2 or not piece:
+            pattern.append(re.escape(piece))
+            continue
+        upper = piece.upper()
+        if keep or upper in _SHAPE_KEYWORDS:
+            keep = upper in ('LIMIT', 'OFFSET', 'INTO')
+            pattern.append(re.escape(piece))
+            continue
+        number = numbers.get(piece)
+        if number is None:
+            number = numbers[piece] = len(params)
+            params.append(piece)
+            pattern.append(_VALUE_GROUP)
+        else:
+            pattern.append(f"(?:\\{number + 1})")
+        pieces[position] = f"__param{number}__"
+    return ''.join(pieces), params, ''.join(pattern)
+
+
+def _binder(value):
+    """A function of a command's values that rebuilds value, a parsed argument, with them in its placeholders."""
+    if isinstance(value, str):
+        if '__param' not in value:
+            return lambda params: value
+        match = _PARAM_PATTERN.fullmatch(value)
+        if match:
+            index = int(match.group(1))
+            return lambda params: params[index]
+        template = _PARAM_PATTERN.sub(r'{\1}', value.replace('{', '{{').replace('}', '}}'))
+        return lambda params: template.format(*params)
+    if isinstance(value, (list, tuple)):
+        kind, parts = type(value), [_binder(item) for item in value]
+        return lambda params: kind([part(params) for part in parts])
+    if isinstance(value, dict):
+        items = [(key, _binder(item)) for key, item in value.items()]
+        return lambda params: {key: part(params) for key, part in items}
+    return lambda params: value
+
+
+class _Planned(BaseException):
+    """Ends the parse of a command shape, carrying the MyLib call it parsed into."""
+
+    def __init__(self, name, args, kwargs):
+        super(_Planned, self).__init__(name)
+        self.name, self.args, self.kwargs = name, args, kwargs
+
+
+class _PlanRecorder:
+    # Stands in for MyLib while a shape is parsed by MyLibShell; the first call is the plan
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            raise _Planned(name, args, kwargs)
+        return call
+
+
+class BatchRunner:
+    """
+    Runs shell commands non-interactively against one resident MyLib and
+    writes one NDJSON object per command. Each distinct shape of a prepared
+    command is parsed once by MyLibShell into a plan, the MyLib call with
+    placeholders for its values; later lines of that shape are matched by the
+    shape's regex and only bind their values. Other commands run in the shell
+    with their output captured.
+    """
+
+    def __init__(self, db=None, plans=PLAN_CACHE_SIZE):
+        self.db = db if db is not None else MyLib()
+        self.shell = MyLibShell(self.db)
+        self.planner = MyLibShell(_PlanRecorder())
+        self.plans = {}  # Command -> [(shape regex, plan)], most recently used first
+        self.size = plans
+
+    def prepare(self, line):
+        """(plan, values) for line; plan is (method, args binder, kwargs binder), or None to run the line in the shell."""
+        plans = self.plans.setdefault(line.partition(' ')[0], [])
+        for position, (matcher, plan) in enumerate(plans):
+            match = matcher.fullmatch(line)
+            if match is not None:
+                if position:
+                    plans.insert(0, plans.pop(position))
+                return plan, match.groups()
+
+        shape, params, pattern = command_shape(line)
+        plan = self._plan(shape)
+        plans.insert(0, (re.compile(pattern), plan))
+        del plans[self.size:]
+        return plan, params
+
+    def _plan(self, shape):
+        # INTO writes a file while the shell parses, so those commands are never planned
+        if shape.split(None, 1)[0] not in BATCH_PREPARED or re.search(r'\bINTO\b', shape, re.IGNORECASE):
+            return None
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.planner.onecmd(shape)
+        except _Planned as planned:
+            kwargs = dict(planned.kwargs)
+            kwargs.pop('out', None)
+            return (planned.name, _binder(planned.args), _binder(kwargs))
+        return None
+
+    def execute(self, line):
+        """Run one command line; returns (result, stop)."""
+        plan, params = self.prepare(line)
+        if plan is None:
+            output = io.StringIO()
+            # cmd.Cmd writes unknown-command errors to its own stdout
+            self.shell.stdout = output
+            with contextlib.redirect_stdout(output):
+                stop = self.shell.onecmd(line)
+            return output.getvalue().rstrip('\n'), stop
+
+        name, args, kwargs = plan
+        result = getattr(self.db, name)(*args(params), **kwargs(params))
+        if isinstance(result, str) and result.startswith(('[', '{')):
+            result = json.loads(result)
+        return result, False
+
+    def run(self, lines, out=None):
+        """Execute lines until they run out or EXIT; blank lines and # comments are skipped. Returns the count run."""
+        out = out if out is not None else sys.stdout
+        count = 0
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            count += 1
+            try:
+                result, stop = self.execute(line)
+                entry = {'line': number, 'command': line, 'result': result}
+            except Exception as error:
+                stop = False
+                entry = {'line': number, 'command': line, 'error': str(error)}
+            out.write(json.dumps(entry, default=_plain) + '\n')
+            if stop:
+                break
+        return count
+
+
+class ShardError(Exception):
+    """A MyLib call failed inside a shard worker."""
+
+
+def _shard_worker(connection):
+    """
+    Serve one shard: a MyLib of its own answering (calls, traced) messages,
+    calls a batch of (method, args, kwargs), with their results in order and,
+    when traced, the PROFILE counters of the batch. Runs until the connection
+    closes or None arrives.
+    """
+    db = MyLib()
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        calls, traced = message
+        results = []
+        with tracing() if traced else contextlib.nullcontext() as trace:
+            for name, args, kwargs in calls:
+                try:
+                    results.append(getattr(db, name)(*args, **kwargs))
+                except Exception as error:
+                    results.append(ShardError(f"{type(error).__name__}: {error}"))
+        connection.send((results, dict(trace) if traced else None))
+    connection.close()
+
+
+def _shard_authkey(address, authkey=None):
+    """
+    The key shard connections to or from address authenticate with: authkey,
+    else $MYLIB_SHARD_AUTHKEY. Shard calls arrive pickled, so anyone who can
+    connect can run code; without a key only loopback and Unix socket
+    addresses are allowed.
+    """
+    authkey = authkey or os.environ.get(SHARD_AUTHKEY_ENV)
+    if authkey:
+        return authkey.encode() if isinstance(authkey, str) else authkey
+    tcp = _tcp_address(address)
+    if tcp is not None:
+        try:
+            loopback = ipaddress.ip_address(tcp[0]).is_loopback
+        except ValueError:
+            loopback = tcp[0] == 'localhost'
+        if not loopback:
+            raise ValueError(f"Shard address {address} is not loopback: set {SHARD_AUTHKEY_ENV} or --shard-authkey")
+    return None
+
+
+def serve_shard(address, authkey=None):
+    """Run a shard worker on a TCP or Unix socket for a coordinator on another machine, one coordinator at a time."""
+    authkey = _shard_authkey(address, authkey)
+    with multiprocessing.connection.Listener(_tcp_address(address) or address, authkey=authkey) as listener:
+        print(f"MyLib shard listening on {address}")
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except multiprocessing.AuthenticationError:
+                    print("MyLib shard refused a coordinator with the wrong key")
+                    continue
+                with connection:
+                    _shard_worker(connection)
+        except KeyboardInterrupt:
+            pass
+
+
+def _shard_of(value, shards):
+    # crc32 rather than hash(): string hashes differ between processes. Coerced like conditions, so 7 and "7" agree
+    return zlib.crc32(repr(_coerce(value)).encode()) % shards
+
+
+def _shard_route(condition, key, shards):
+    """The only shard that can hold rows matching condition, when it pins key with key = value; else None."""
+    if not isinstance(condition, (list, tuple)) or not condition:
+        return None
+    if condition[0] == 'AND' and isinstance(condition[1], (list, tuple)):
+        for part in condition[1:]:
+            shard = _shard_route(part, key, shards)
+            if shard is not None:
+                return shard
+        return None
+    if condition[0] in ('OR', 'NOT') and isinstance(condition[1], (list, tuple)):
+        return None
+    if condition[0] == key and condition[1] == '=':
+        return _shard_of(condition[2], shards)
+    return None
+
+
+def _shard_total(results, prefix):
+    """Add up the "<prefix><number>" answers of the shards; any other answer is an error and is returned as is."""
+    total = 0
+    for result in results:
+        if not isinstance(result, str) or not result.startswith(prefix):
+            return result
+        total += json.loads(result[len(prefix):])
+    return f"{prefix}{total}"
+
+
+def _shard_message(results, succeeded):
+    """One answer for a write sent to several shards: an error wins, then success on any shard, else the first answer."""
+    for result in results:
+        if not succeeded(result) and not result.startswith('No '):
+            return result
+    for result in results:
+        if succeeded(result):
+            return result
+    return results[0]
+
+
+_SHARD_AVERAGE = re.compile(r'--- Page AVG: (\S+)\t\n--- Published Year AVG: (\S+)')
+# MyLib methods that only change shard-local settings or files, so they go to every shard unchanged
+SHARD_BROADCAST = ('create_index', 'drop_index', 'begin', 'commit', 'save_dataset', 'cache_columns',
+                   'set_parallel', 'set_compact', 'set_memory_budget', 'datasets')
+
+
+class ShardedLib:
+    """
+    Coordinator for a dataset hash-partitioned by one key field across shard
+    workers, each a MyLib in its own process with its own files. Writes go
+    only to the shard owning the key when their condition pins it with
+    key = value, else to every shard; reads are sent to all shards at once
+    and their partial answers merged. Has the MyLib methods MyLibShell and
+    BatchRunner call, so either can run on top of it.
+
+    Workers are local processes, or with addresses shard workers started
+    elsewhere with --shard-worker; paths such as JOIN's other dataset are
+    then resolved on each worker's machine.
+    """
+
+    # Condition building, paging and output are the same as in MyLib
+    _where = MyLib._where
+    _page = MyLib._page
+    _emit = MyLib._emit
+
+    def __init__(self, shards=PARALLEL_WORKERS, key=SHARD_KEY, addresses=None, authkey=None):
+        self.key = key
+        self.connections = []
+        self.workers = []
+        if addresses:
+            for address in addresses:
+                self.connections.append(
+                    multiprocessing.connection.Client(_tcp_address(address) or address,
+                                                      authkey=_shard_authkey(address, authkey)))
+        else:
+            for _ in range(shards):
+                connection, child = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=_shard_worker, args=(child,), daemon=True)
+                worker.start()
+                child.close()
+                self.connections.append(connection)
+                self.workers.append(worker)
+        # MyLibShell only checks that these are set; current_data holds the shard dataset names
+        self.current_data = None
+        self.current_file = None
+        self.stream_source = None
+        self.hooks = []
+        self.explaining = False
+
+    def close(self):
+        for connection in self.connections:
+            with contextlib.suppress(OSError):
+                connection.send(None)
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections, self.workers = [], []
+
+    def _scatter(self, calls):
+        """
+        Send calls[i], a list of (method, args, kwargs) or None, to shard i.
+        Everything is sent before any answer is read, so the shards work
+        at the same time. Returns each shard's list of results, or None.
+        Under EXPLAIN the last call is planned by the first shard instead.
+        """
+        targets = [position for position, batch in enumerate(calls) if batch]
+        if self.explaining and targets:
+            self._explain(*calls[targets[0]][-1], targets)
+        trace = _active_trace()
+        for connection, batch in zip(self.connections, calls):
+            if batch:
+                connection.send((batch, trace is not None))
+        answers = []
+        for connection, batch in zip(self.connections, calls):
+            if not batch:
+                answers.append(None)
+                continue
+            results, shard_trace = connection.recv()
+            for key, value in (shard_trace or {}).items():
+                trace[key] += value
+            answers.append(results)
+        return answers
+
+    def _explain(self, name, args, kwargs, targets):
+        """Raise Explained with how the coordinator spreads the call, then the first target shard's plan of it."""
+        arguments = inspect.signature(getattr(MyLib, name)).bind(None, *args, **kwargs).arguments
+        del arguments['self']
+        connection = self.connections[targets[0]]
+        connection.send(([('explain', (name, arguments), {})], False))
+        plan = connection.recv()[0][0]
+        if len(targets) == 1 and len(self.connections) > 1:
+            spread = f"routed to shard {targets[0]} of {len(self.connections)} by {self.key}"
+        else:
+            spread = f"sent to all {len(self.connections)} shards and merged"
+        raise Explained(f"Shards: {spread}\n{plan}")
+
+    def _call(self, name, *args, shard=None, **kwargs):
+        """Results of one MyLib call on shard, or on every shard when shard is None; a failed call raises."""
+        call = [(name, args, kwargs)]
+        calls = [call if shard is None or shard == position else None for position in range(len(self.connections))]
+        results = []
+        for position, batch in enumerate(self._scatter(calls)):
+            if batch is None:
+                continue
+            if isinstance(batch[0], ShardError):
+                raise ShardError(f"Shard {position}: {batch[0]}")
+            results.append(batch[0])
+        return results
+
+    def __getattr__(self, name):
+        if name not in SHARD_BROADCAST:
+            raise AttributeError(name)
+
+        def broadcast(*args, **kwargs):
+            results = self._call(name, *args, **kwargs)
+            if all(result == results[0] for result in results):
+                return results[0]
+            return '\n'.join(f"Shard {position}: {result}" for position, result in enumerate(results))
+        return broadcast
+
+    def create_dataset(self, filename):
+        """Create an empty sharded dataset: one empty shard per worker and its <filename>.shards layout."""
+        if os.path.exists(filename + SHARD_MANIFEST) or dataset_path(filename) is not None:
+            return f"Dataset {filename} already exists!"
+        names = [f"{filename}.shard{position}" for position in range(len(self.connections))]
+        for (result,) in self._scatter([[('create_dataset', (name,), {})] for name in names]):
+            if not isinstance(result, str) or not result.endswith('created.'):
+                return str(result)
+        with open(filename + SHARD_MANIFEST, 'w') as file:
+            json.dump({'key': self.key, 'shards': len(names), 'source': None}, file)
+        return f"Dataset {filename} created in {len(names)} shards by {self.key}."
+
+    def close_dataset(self, filename):
+        """Close the shards of filename in every worker."""
+        names = [f"{filename}.shard{position}" for position in range(len(self.connections))]
+        results = [batch[0] for batch in self._scatter([[('close_dataset', (name,), {})] for name in names])]
+        if self.current_data == names:
+            self.current_data = self.current_file = None
+        if all(result == results[0] for result in results):
+            return results[0]
+        return '\n'.join(f"Shard {position}: {result}" for position, result in enumerate(results))
+
+    def convert_dataset(self, filename, target):
+        return "CONVERT is not supported when sharded: shards are always chunked."
+
+    def chunk_dataset(self, filename, chunk_size=CHUNK_SIZE):
+        return "CHUNK is not supported when sharded: shards are always chunked."
+
+    def open_stream(self, filename):
+        return "STREAM is not supported when sharded; LOAD the dataset instead."
+
+    def close_stream(self):
+        self.stream_source = None
+
+    def _route(self, field, operator, value, where):
+        try:
+            condition = self._where(field, operator, value, where)
+        except ValueError:
+            return None  # Every shard reports the bad condition itself
+        return _shard_route(condition, self.key, len(self.connections))
+
+    def load_dataset(self, filename):
+        """
+        Open filename's shards, splitting <filename> into them by the key
+        field first when it has not been sharded yet. The split is recorded
+        in <filename>.shards, which fixes the key and the number of shards.
+        """
+        shards = len(self.connections)
+        names = [f"{filename}.shard{position}" for position in range(shards)]
+        manifest = filename + SHARD_MANIFEST
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as file:
+                layout = json.load(file)
+            if layout['shards'] != shards:
+                return f"Dataset {filename} is split into {layout['shards']} shards, not {shards}."
+            self.key = layout['key']
+        else:
+            path = dataset_path(filename)
+            if path is None:
+                return f"File {filename}.json not found!"
+            parts = [[] for _ in range(shards)]
+            for record in stream_dataset(path):
+                parts[_shard_of(record.get(self.key), shards)].append(record)
+            created = self._scatter([[('create_dataset', (name, part), {})] for name, part in zip(names, parts)])
+            for (result,) in created:
+                if not isinstance(result, str) or not result.endswith('created.'):
+                    return str(result)
+            with open(manifest, 'w') as file:
+                json.dump({'key': self.key, 'shards': shards, 'source': path}, file)
+
+        for (result,) in self._scatter([[('load_dataset', (name,), {})] for name in names]):
+            if not isinstance(result, str) or not result.endswith('loaded.'):
+                return str(result)
+        self.current_data = names
+        self.current_file = manifest
+        return f"Dataset {filename} loaded in {shards} shards by {self.key}."
+
+    def add_record(self, record):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        if not isinstance(record, dict) or self.key not in record:
+            return f"Record has no {self.key} to place it by."
+        return self._call('add_record', record, shard=_shard_of(record[self.key], len(self.connections)))[0]
+
+    def add_records(self, records):
+        """Insert many records, each shard taking its own in one batch at the same time as the others."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        parts = [[] for _ in self.connections]
+        skipped = 0
+        error = None
+        try:
+            for record in records:
+                if not isinstance(record, dict) or self.key not in record:
+                    skipped += 1
+                    continue
+                parts[_shard_of(record[self.key], len(parts))].append(record)
+        except ValueError as invalid:
+            error = invalid  # Like MyLib: the records before a malformed NDJSON line are still added
+
+        added = 0
+        for position, batch in enumerate(self._scatter([[('add_records', (part,), {})] if part else None
+                                                        for part in parts])):
+            if batch is None:
+                continue
+            match = re.match(r'(\d+) records added, (\d+) skipped\.', str(batch[0]))
+            if match is None:
+                raise ShardError(f"Shard {position}: {batch[0]}")
+            added += int(match.group(1))
+            skipped += int(match.group(2))
+        if error is not None:
+            return f"{error} Stopped there: {added} records added, {skipped} skipped."
+        return f"{added} records added, {skipped} skipped."
+
+    def update_record(self, field, new_value, condition_field, condition_operator, condition_value, where=None):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        if field == self.key:
+            return f"Cannot update the shard key {field}; delete and add the records again instead."
+        shard = self._route(condition_field, condition_operator, condition_value, where)
+        results = self._call('update_record', field, new_value, condition_field, condition_operator,
+                             condition_value, where=where, shard=shard)
+        return _shard_message(results, lambda result: result == "Record updated successfully.")
+
+    def update_by_value(self, field, new_value, condition_field, condition_value):
+        if field == self.key:
+            raise ValueError(f"cannot update the shard key {field}")
+        shard = _shard_of(condition_value, len(self.connections)) if condition_field == self.key else None
+        return sum(self._call('update_by_value', field, new_value, condition_field, condition_value, shard=shard))
+
+    def delete_record(self, condition_field, condition_operator, condition_value, where=None):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        shard = self._route(condition_field, condition_operator, condition_value, where)
+        results = self._call('delete_record', condition_field, condition_operator, condition_value,
+                             where=where, shard=shard)
+        return _shard_message(results, lambda result: result.endswith("have been deleted."))
+
+    def _gather_rows(self, results):
+        """Each shard's rows from its JSON answer, empty for a no-match message; (None, error) on any other answer."""
+        parts = []
+        for result in results:
+            if not isinstance(result, str):
+                return None, result
+            if result.startswith('['):
+                parts.append(json.loads(result))
+            elif result.startswith(('No books found', 'No books match')):
+                parts.append([])
+            else:
+                return None, result
+        return parts, None
+
+    def find_books(self, field, value, operator, where=None, limit=None, offset=0, out=None):
+        """Matching rows of every shard, shard by shard; each shard returns at most the rows the page can use."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        shard = self._route(field, operator, value, where)
+        window = None if limit is None else offset + limit
+        parts, error = self._gather_rows(self._call('find_books', field, value, operator, where=where,
+                                                    limit=window, shard=shard))
+        if error is not None:
+            return error
+
+        rows = self._page(itertools.chain.from_iterable(parts), limit, offset)
+        if rows is None:
+            return f"No books found with {format_condition(self._where(field, operator, value, where))}"
+        return self._emit(rows, out)
+
+    def sort_by(self, field, condition_field=None, condition_operator=None, condition_value=None, order='ASC',
+                where=None, limit=None, offset=0, out=None):
+        """Each shard sorts its own matches, top offset + limit only when paged, and the sorted runs are merged."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        shard = self._route(condition_field, condition_operator, condition_value, where)
+        window = None if limit is None else offset + limit
+        parts, error = self._gather_rows(self._call(
+            'sort_by', field, condition_field, condition_operator, condition_value, order,
+            where=where, limit=window, shard=shard))
+        if error is not None:
+            return error
+
+        # The same direction MyLib.sort_by sorts each shard in
+        reverse = order.upper() == ("ASC" if field in ["pages", "isbn"] else "DESC")
+        page = self._page(heapq.merge(*parts, key=lambda x: x.get(field), reverse=reverse), limit, offset)
+        if page is None:
+            if where is not None or (condition_field and condition_operator and condition_value):
+                return "No books match the provided condition."
+            page = iter(())
+        return self._emit(page, out)
+
+    def join(self, other_dataset, field, mode='inner', out=None):
+        """Every shard joins its rows with the whole of other_dataset; the results are concatenated."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        results = self._call('join', other_dataset, field, mode)
+        if mode.lower() != 'group':
+            parts, error = self._gather_rows(results)
+            return error if error is not None else self._emit(itertools.chain.from_iterable(parts), out)
+
+        # Grouped joins are keyed by value; each shard has the other side's full list for a value
+        joined_data = {}
+        for result in results:
+            if not result.startswith('{'):
+                return result
+            for value, sides in json.loads(result).items():
+                joined_data.setdefault(value, {'self': [], 'other': sides['other']})['self'].extend(sides['self'])
+        return json.dumps(joined_data, indent=4, default=_plain)
+
+    def group_by(self, keys, aggregates, where=None, limit=None, offset=0, out=None):
+        """Every shard's hash aggregation table, merged in shard order before the aggregates are computed."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        try:
+            condition = self._where(None, None, None, where)
+            compile_condition(condition)
+        except ValueError:
+            return "Invalid condition operator."
+
+        keys = list(keys)
+        fields = sorted({field for _, field in aggregates if field is not None})
+        shard = _shard_route(condition, self.key, len(self.connections))
+        if self.explaining:
+            targets = range(len(self.connections)) if shard is None else [shard]
+            self._explain('group_by', (keys, aggregates), {'where': condition}, list(targets))
+        groups = {}
+        for part in self._call('_groups', keys, fields, condition, shard=shard):
+            _merge_groups(groups, part)
+
+        results = self._page(_group_results(groups, keys, aggregates), limit, offset)
+        if results is None:
+            return "No books match the provided condition."
+        return self._emit(results, out)
+
+    def count(self, field, operator, value, where=None):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        shard = self._route(field, operator, value, where)
+        return _shard_total(self._call('count', field, operator, value, where=where, shard=shard), "Total Records ")
+
+    def sum(self, field, operator, value, where=None):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        shard = self._route(field, operator, value, where)
+        return _shard_total(self._call('sum', field, operator, value, where=where, shard=shard), "Total Pages ")
+
+    def average(self, field, operator, value, where=None):
+        """Shard averages weighted by each shard's count, both asked for in one round trip."""
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        shard = self._route(field, operator, value, where)
+        calls = [('count', (field, operator, value), {'where': where}),
+                 ('average', (field, operator, value), {'where': where})]
+        count = pages = years = 0
+        for position, batch in enumerate(self._scatter([calls if shard is None or shard == position else None
+                                                        for position in range(len(self.connections))])):
+            if batch is None:
+                continue
+            total, averages = batch
+            for result in batch:
+                if isinstance(result, ShardError):
+                    raise ShardError(f"Shard {position}: {result}")
+            if not total.startswith("Total Records "):
+                return total
+            match = _SHARD_AVERAGE.match(averages)
+            if match is None:
+                if averages == "No books match the provided condition.":
+                    continue
+                return averages
+            rows = int(total[len("Total Records "):])
+            count += rows
+            pages += float(match.group(1)) * rows
+            years += float(match.group(2)) * rows
+            if field is not None or where is not None:
+                # Conditioned shard sums are whole numbers, so rounding undoes the division exactly
+                pages, years = round(pages), round(years)
+
+        if not count:
+            return "No books match the provided condition."
+        return f"--- Page AVG: {pages / count}\t\n--- Published Year AVG: {years / count}"
+
+    def Max(self):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        prefix = "--- Book With Maximum Pages: "
+        results = self._call('Max')
+        for result in results:
+            if not result.startswith(prefix):
+                return result
+        return f"{prefix}{max(json.loads(result[len(prefix):]) for result in results)}"
+
+    def minimum(self):
+        if self.current_data is None:
+            return "No dataset loaded. Load a dataset first."
+        prefix = "--- Book With Miimum Pages: "
+        # An empty shard has no minimum and fails, like MyLib on an empty dataset; only the others count
+        results = [batch[0] for batch in self._scatter([[('minimum', (), {})]] * len(self.connections))]
+        values = [json.loads(result[len(prefix):]) for result in results
+                  if isinstance(result, str) and result.startswith(prefix)]
+        if not values:
+            raise ShardError(str(results[0]))
+        return f"{prefix}{min(values)}"
+
+
 if __name__ == '__main__':
-    MyLibShell().cmdloop()
+    parser = argparse.ArgumentParser(description='MyLib book database shell')
+    parser.add_argument('--serve', nargs='?', const=SERVER_ADDRESS, metavar='ADDRESS',
+                        help=f'run a server on host:port or a Unix socket path (default {SERVER_ADDRESS})')
+    parser.add_argument('--connect', nargs='?', const=SERVER_ADDRESS, metavar='ADDRESS',
+                        help='run the shell against a server')
+    parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help='run the commands in FILE (default stdin) and write one NDJSON result per command')
+    parser.add_argument('--shards', metavar='N|ADDRESS,...',
+                        help='hash-partition datasets across N local worker processes, or the shard workers at ADDRESSes')
+    parser.add_argument('--shard-key', default=SHARD_KEY, metavar='FIELD',
+                        help=f'field new datasets are partitioned by (default {SHARD_KEY})')
+    parser.add_argument('--shard-worker', metavar='ADDRESS', help='run a shard worker on host:port or a Unix socket path')
+    parser.add_argument('--shard-authkey', metavar='KEY',
+                        help=f'key shard workers and coordinators authenticate with (default ${SHARD_AUTHKEY_ENV}); '
+                             'required for non-loopback addresses')
+    options = parser.parse_args()
+
+    db = None
+    try:
+        if options.shards:
+            if options.shards.isdigit():
+                db = ShardedLib(int(options.shards), options.shard_key)
+            else:
+                db = ShardedLib(key=options.shard_key, addresses=options.shards.split(','),
+                                authkey=options.shard_authkey)
+        elif options.shard_worker:
+            _shard_authkey(options.shard_worker, options.shard_authkey)
+    except ValueError as error:
+        parser.error(str(error))
+    except multiprocessing.AuthenticationError:
+        parser.error("A shard worker rejected the key: use the one it was started with")
+
+    try:
+        if options.shard_worker:
+            serve_shard(options.shard_worker, options.shard_authkey)
+        elif options.batch:
+            if options.batch == '-':
+                BatchRunner(db).run(sys.stdin)
+            else:
+                with open(options.batch, 'r') as file:
+                    BatchRunner(db).run(file)
+        elif options.serve:
+            serve(options.serve)
+        elif options.connect:
+            RemoteShell(options.connect).cmdloop()
+        else:
+            MyLibShell(db).cmdloop()
+    finally:
+        if db is not None:
+            db.close()
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import script
+
+
+class BatchTest(unittest.TestCase):
+    """An open batch survives another writer's checkpoint, and concurrent writes are logged once each."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        with open('books.json', 'w') as file:
+            json.dump([{'title': f'b{i}', 'pages': i} for i in range(10)], file)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def titles(self):
+        db = script.MyLib()
+        db.load_dataset('books')
+        return sorted(record['title'] for record in db.current_data)
+
+    def test_batch_survives_checkpoint(self):
+        # Two MyLib instances stand for two processes sharing the dataset
+        first, second = script.MyLib(), script.MyLib()
+        first.load_dataset('books')
+        second.load_dataset('books')
+
+        first.begin()
+        first.add_record({'title': 'batched', 'pages': 1})
+        second.add_record({'title': 'other', 'pages': 2})
+        second.save_dataset()
+        first.add_record({'title': 'after', 'pages': 3})
+        self.assertEqual(first.commit(), "Batch of 2 changes committed.")
+
+        self.assertEqual(first.count(None, None, None), "Total Records 13")
+        self.assertEqual(self.titles(), sorted([f'b{i}' for i in range(10)] + ['batched', 'other', 'after']))
+
+    def test_concurrent_writes(self):
+        db = script.MyLib()
+        db.load_dataset('books')
+
+        def add(thread):
+            for i in range(25):
+                db.add_record({'title': f't{thread}-{i}', 'pages': i})
+
+        threads = [threading.Thread(target=add, args=(thread,)) for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.add_record({'title': 't0-0'}), "Record with this title already exists.")
+        self.assertEqual(len(self.titles()), 110)
+        self.assertEqual(len(set(self.titles())), 110)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import script
+
+
+RECORDS = [{'title': f'b{i}', 'pages': i * 7 % 300, 'publishedYear': 1990 + i % 5, 'status': 'abc'[i % 3]}
+           for i in range(200)]
+
+
+class ShardedLibTest(unittest.TestCase):
+    """A dataset split across shards answers every query as the same dataset in one MyLib does."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        with open('books.json', 'w') as file:
+            json.dump(RECORDS, file)
+        self.single = script.MyLib()
+        self.single.load_dataset('books')
+        self.sharded = script.ShardedLib(2)
+        self.sharded.load_dataset('books')
+
+    def tearDown(self):
+        self.sharded.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def assert_same(self, method, *args, **kwargs):
+        self.assertEqual(getattr(self.sharded, method)(*args, **kwargs), getattr(self.single, method)(*args, **kwargs))
+
+    def assert_same_rows(self, method, *args, **kwargs):
+        # Shards return their rows in shard order; the rows themselves must match
+        rows = [json.loads(getattr(db, method)(*args, **kwargs)) for db in (self.sharded, self.single)]
+        key = lambda row: json.dumps(row, sort_keys=True)
+        self.assertEqual(sorted(rows[0], key=key), sorted(rows[1], key=key))
+
+    def test_aggregates(self):
+        for condition in [(None, None, None), ('pages', '>', 100), ('title', '=', 'b7'), ('publishedYear', '<=', 1991)]:
+            with self.subTest(condition=condition):
+                self.assert_same('count', *condition)
+                self.assert_same('sum', *condition)
+                self.assert_same('average', *condition)
+        self.assert_same('Max')
+        self.assert_same('minimum')
+
+    def test_find_and_group_by(self):
+        self.assert_same_rows('find_books', 'pages', 100, '>')
+        self.assert_same_rows('find_books', 'title', 'b7', '=')
+        self.assert_same_rows('group_by', ['status'], [('COUNT', None), ('SUM', 'pages'), ('MAX', 'pages')])
+        self.assert_same_rows('group_by', ['publishedYear'], [('AVG', 'pages')], where=('status', '=', 'a'))
+        self.assert_same('sort_by', 'pages', limit=10)
+
+    def test_writes(self):
+        for db in (self.sharded, self.single):
+            db.add_record({'title': 'new', 'pages': 299, 'publishedYear': 2000, 'status': 'a'})
+            db.update_record('pages', 5, 'status', '=', 'b')
+            db.delete_record('title', '=', 'b3')
+        self.assert_same('count', None, None, None)
+        self.assert_same('sum', None, None, None)
+        self.assert_same_rows('find_books', 'pages', 200, '>')
+
+
+if __name__ == '__main__':
+    unittest.main()
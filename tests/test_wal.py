@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import script
+
+
+RECORDS = [{'title': f'b{i}', 'pages': i} for i in range(30)]
+
+
+class WalReplayTest(unittest.TestCase):
+    """Writes logged before a crash come back exactly once on the next LOAD, in every storage format."""
+
+    formats = ('json', 'binary', 'chunked')
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def create(self, storage):
+        # Each format in a directory of its own
+        os.mkdir(os.path.join(self.directory, storage))
+        os.chdir(os.path.join(self.directory, storage))
+        if storage == 'chunked':
+            script.MyLib().create_dataset('books', RECORDS, chunk_size=8)
+        else:
+            with open('books.json', 'w') as file:
+                json.dump(RECORDS, file)
+            if storage == 'binary':
+                script.MyLib().convert_dataset('books', 'binary')
+
+    def write(self, db):
+        db.add_record({'title': 'new', 'pages': 500})
+        db.update_record('pages', 1000, 'title', '=', 'b3')
+        db.delete_record('title', '=', 'b4')
+
+    def assert_written(self):
+        db = script.MyLib()
+        db.load_dataset('books')
+        titles = [record['title'] for record in db.current_data]
+        self.assertEqual(sorted(titles), sorted([f'b{i}' for i in range(30) if i != 4] + ['new']))
+        self.assertEqual(db.find_books('title', 'b3', '=').count('1000'), 1)
+        self.assertEqual(db.count(None, None, None), 'Total Records 30')
+        self.assertEqual(db.sum(None, None, None), f"Total Pages {sum(range(30)) - 3 - 4 + 1000 + 500}")
+
+    def test_replay_after_crash(self):
+        for storage in self.formats:
+            with self.subTest(storage=storage):
+                self.create(storage)
+                db = script.MyLib()
+                db.load_dataset('books')
+                self.write(db)
+                self.assertTrue(os.path.exists(db._log_path()))
+                del db  # Crashed: the writes reached only the log
+                self.assert_written()
+
+    def test_crash_before_log_removed(self):
+        # The base files hold every write already; the checkpoint marker keeps the log from applying twice
+        for storage in self.formats:
+            with self.subTest(storage=storage):
+                self.create(storage)
+                db = script.MyLib()
+                db.load_dataset('books')
+                self.write(db)
+                log = db._log_path()
+                remove = os.remove
+
+                def crash(path):
+                    if path == log:
+                        raise OSError('crash')
+                    remove(path)
+
+                with mock.patch('script.os.remove', crash):
+                    with self.assertRaises(OSError):
+                        db.save_dataset()
+                self.assertTrue(os.path.exists(log + '.checkpoint'))
+                del db
+                self.assert_written()
+
+    def test_crash_before_manifest_replaced(self):
+        # New chunk files are written first; the old manifest still names the old ones
+        self.create('chunked')
+        db = script.MyLib()
+        db.load_dataset('books')
+        self.write(db)
+        replace = os.replace
+
+        def crash(source, target):
+            if target.endswith(script.MANIFEST_FILE):
+                raise OSError('crash')
+            replace(source, target)
+
+        with mock.patch('script.os.replace', crash):
+            with self.assertRaises(OSError):
+                db.save_dataset()
+        del db
+        self.assert_written()
+
+
+if __name__ == '__main__':
+    unittest.main()